@@ -1,13 +1,25 @@
-import os
 import re
+import asyncio
+import contextvars
+import threading
+import time
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import heapq
-from typing import List, Dict, Tuple
-from langchain_mistralai import ChatMistralAI
+import itertools
+from typing import Awaitable, Callable, Iterator, List, Dict, Optional, Tuple
 from langchain.prompts import ChatPromptTemplate
 from langchain.schema.runnable import RunnablePassthrough
 
-from utils.pretty_print import colored_print
+from llm_cache import CachedRunnable, llm_cache, model_name
+from llm_gateway import LLMTimeout, latency_summary, llm_gateway, timed_out
+from metrics import node_labels, record_nodes, record_step
+from tracing import span
+from structured_log import get_logger
+from branch_history import HistoryCompactor
+from judge_memo import MemoizedJudge, judge_memo
+from prejudge import PreJudge
+from prompt_stream import aiter_prompt_blocks
 
 # Assuming these templates are defined elsewhere
 from agent_templates import (
@@ -16,6 +28,10 @@ from agent_templates import (
     judge_template,
 )
 
+SEARCH_MODES = ("bfs", "best_first")
+
+log = get_logger("attack")
+
 
 class SecurityTest:
     def __init__(
@@ -25,35 +41,122 @@ class SecurityTest:
         max_width: int = 3,
         max_depth: int = 3,
         top_k: int = 5,
+        max_concurrency: int = 8,
+        max_parallel_scenarios: int = 5,
+        attack_scenarios: Optional[List[str]] = None,
+        history_compactor: Optional[HistoryCompactor] = None,
+        success_threshold: Optional[int] = None,
+        prune_below: Optional[int] = None,
+        patience: Optional[int] = None,
+        prejudge: Optional[PreJudge] = None,
+        search_mode: str = "bfs",
+        call_budget: Optional[int] = None,
+        frontier_batch_size: int = 3,
+        stream_generation: bool = False,
+        on_event: Optional[Callable[[str, Dict], None]] = None,
     ):
+        if search_mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode {search_mode!r}, expected one of {SEARCH_MODES}")
+
         self.system_prompt = system_prompt
         self.branching_factor = branching_factor
         self.max_width = max_width
         self.max_depth = max_depth
         self.top_k = top_k
+        # Upper bound on in-flight LLM calls per batch in the async mode
+        self.max_concurrency = max_concurrency
+        # Number of scenario trees searched side by side
+        self.max_parallel_scenarios = max_parallel_scenarios
+        # Scenarios are pinned once known so run() searches exactly those
+        self.attack_scenarios = attack_scenarios
+        # Controls how much of a branch is replayed to the attacker chain
+        self.history_compactor = history_compactor or HistoryCompactor()
+        # Stop conditions: a score >= success_threshold ends the scenario,
+        # nodes scoring below prune_below are not expanded, and a branch
+        # stops after `patience` levels without beating its parent
+        self.success_threshold = success_threshold
+        self.prune_below = prune_below
+        self.patience = patience
+        # Local verdicts for clear-cut responses; pass PreJudge(rules=())
+        # to send every response to the LLM judge
+        self.prejudge = prejudge if prejudge is not None else PreJudge()
+        # "bfs" searches every scenario tree level by level; "best_first"
+        # expands the highest-scored nodes of all scenarios from one shared
+        # frontier until call_budget LLM calls have been spent
+        self.search_mode = search_mode
+        self.call_budget = call_budget
+        # Nodes expanded concurrently per step of the async best-first search
+        self.frontier_batch_size = frontier_batch_size
+        # Async search only: run and judge each attack prompt as soon as the
+        # attacker has finished writing it instead of after the whole reply
+        self.stream_generation = stream_generation
+        # Receives progress events (node_created, node_scored, node_stopped,
+        # pruned, new_best) as (type, data); called from worker threads too
+        self.on_event = on_event
+        self.best_scores: Dict[str, int] = {}
+
+        self.stats_lock = threading.Lock()
+        self.search_stats = {
+            "search_llm_calls": 0,
+            "expansions": 0,
+            "stopped_success": 0,
+            "pruned": 0,
+            "stalled": 0,
+            "estimated_calls_saved": 0,
+            "unexpanded_frontier": 0,
+            "timed_out": 0,
+        }
+        # Wall time of each search step: a whole level in the async BFS, a
+        # batch in the async best-first search, one expansion when sync
+        self.level_seconds: List[float] = []
 
-        # Initialize the Mistral AI language model
-        self.llm = ChatMistralAI(
-            model="mistral-large-latest",
-            api_key=os.environ["MISTRAL_API_KEY"],
+        # All instances share the process-wide rate-limited client
+        self.llm = llm_gateway
+
+        # Raw target-model calls share the response cache with the chains
+        self.target_llm = CachedRunnable(
+            self.llm.role("target", "attack_target"), llm_cache, model_name(self.llm)
         )
 
-        self.consultant_chain = self.create_llm_chain(consultant_template)
-        self.attacker_chain = self.create_llm_chain(attacker_template)
-        self.judge_chain = self.create_llm_chain(judge_template)
+        self.consultant_chain = self.create_llm_chain(
+            consultant_template, "generator", "consultant"
+        )
+        self.attacker_chain = self.create_llm_chain(attacker_template, "generator", "attacker")
+        # Identical judge requests are answered once, even when concurrent
+        self.judge_chain = MemoizedJudge(
+            self.create_llm_chain(judge_template, "judge", "attack_judge"),
+            judge_memo,
+            "attack_judge",
+        )
 
-    def create_llm_chain(self, template: str) -> RunnablePassthrough:
+    def create_llm_chain(self, template: str, role: str, stage: str) -> CachedRunnable:
+        # role picks the gateway's deadline and hedging policy for the calls,
+        # stage labels them in the metrics
         chat_prompt = ChatPromptTemplate.from_template(template)
-        return RunnablePassthrough() | chat_prompt | self.llm
+        chain = RunnablePassthrough() | chat_prompt | self.llm.role(role, stage)
+        return CachedRunnable(chain, llm_cache, model_name(self.llm), template)
 
     def parse_attack_scenarios(self, output: str) -> List[str]:
         scenarios = output.split("###")[1:]
         return [scenario.strip() for scenario in scenarios]
 
     def generate_attack_scenarios(self) -> List[str]:
+        if self.attack_scenarios is not None:
+            return self.attack_scenarios
         response = self.consultant_chain.invoke({"system_prompt": self.system_prompt})
         scenarios = self.parse_attack_scenarios(response.content)
-        return scenarios[:5]  # Limit to 5 scenarios
+        self.attack_scenarios = scenarios[:5]  # Limit to 5 scenarios
+        return self.attack_scenarios
+
+    async def agenerate_attack_scenarios(self) -> List[str]:
+        if self.attack_scenarios is not None:
+            return self.attack_scenarios
+        response = await self.consultant_chain.ainvoke(
+            {"system_prompt": self.system_prompt}
+        )
+        scenarios = self.parse_attack_scenarios(response.content)
+        self.attack_scenarios = scenarios[:5]  # Limit to 5 scenarios
+        return self.attack_scenarios
 
     def parse_attack_prompts(self, output: str) -> List[str]:
         prompts = re.findall(r"-----(.+?)-----", output, re.DOTALL)
@@ -71,22 +174,13 @@ class SecurityTest:
         )
         return self.parse_attack_prompts(response.content)
 
-    def judge_attack(
-        self, goal: str, system_prompt: str, attack_prompt: str, model_response: str
-    ) -> Tuple[int, str]:
-        response = self.judge_chain.invoke(
-            {
-                "attack_scenario": goal,
-                "system_prompt": system_prompt,
-                "model_response": model_response,
-            }
-        )
+    def batch_config(self) -> Dict:
+        return {"max_concurrency": self.max_concurrency}
 
-        score_match = re.search(
-            r"Score:\s*(\d+)", response.content, re.IGNORECASE
-        )
+    def parse_judge_response(self, output: str) -> Tuple[int, str]:
+        score_match = re.search(r"Score:\s*(\d+)", output, re.IGNORECASE)
         feedback_match = re.search(
-            r"Feedback:\s*(.+)", response.content, re.IGNORECASE | re.DOTALL
+            r"Feedback:\s*(.+)", output, re.IGNORECASE | re.DOTALL
         )
 
         if score_match and feedback_match:
@@ -98,31 +192,481 @@ class SecurityTest:
 
         return score, feedback
 
+    def judge_attack(
+        self, goal: str, system_prompt: str, attack_prompt: str, model_response: str
+    ) -> Optional[Tuple[int, str]]:
+        # None when the judge timed out
+        def llm_judge(pending: List[int]) -> List[Optional[Tuple[int, str]]]:
+            try:
+                response = self.judge_chain.invoke(
+                    {
+                        "attack_scenario": goal,
+                        "system_prompt": system_prompt,
+                        "model_response": model_response,
+                    }
+                )
+            except LLMTimeout:
+                return [None]
+            return [self.parse_judge_response(response.content)]
+
+        [verdict] = self.prejudge.apply([attack_prompt], [model_response], llm_judge, [goal])
+        return verdict
+
+    async def agenerate_attack_prompts_batch(
+        self, attack_scenario: str, branch_histories: List[str], num_branches: int
+    ) -> List[Optional[List[str]]]:
+        # None for the histories whose attacker call timed out
+        responses = await self.attacker_chain.abatch(
+            [
+                {
+                    "attack_scenario": attack_scenario,
+                    "branch_history": branch_history,
+                    "num_branches": num_branches,
+                }
+                for branch_history in branch_histories
+            ],
+            config=self.batch_config(),
+            return_exceptions=True,
+        )
+        return [None if timed_out(r) else self.parse_attack_prompts(r.content) for r in responses]
+
+    async def ajudge_attacks(
+        self,
+        goal: str,
+        system_prompt: str,
+        attack_prompts: List[str],
+        model_responses: List[str],
+    ) -> List[Optional[Tuple[int, str]]]:
+        # None for the responses whose judge call timed out
+        async def llm_judge(pending: List[int]) -> List[Optional[Tuple[int, str]]]:
+            responses = await self.judge_chain.abatch(
+                [
+                    {
+                        "attack_scenario": goal,
+                        "system_prompt": system_prompt,
+                        "model_response": model_responses[i],
+                    }
+                    for i in pending
+                ],
+                config=self.batch_config(),
+                return_exceptions=True,
+            )
+            return [
+                None if timed_out(r) else self.parse_judge_response(r.content) for r in responses
+            ]
+
+        return await self.prejudge.aapply(
+            attack_prompts, model_responses, llm_judge, [goal] * len(attack_prompts)
+        )
+
     class Node:
+        """A node of the attack tree.
+
+        Nodes only keep a pointer to their parent; the conversation history
+        of a branch is rebuilt from the path to the root when it is needed,
+        so pruned branches are freed and no text is copied per child.
+        """
+
+        __slots__ = (
+            "prompt",
+            "parent",
+            "depth",
+            "node_id",
+            "scenario",
+            "score",
+            "model_response",
+            "feedback",
+            "stale",
+            "history_chars",
+        )
+
         def __init__(
             self,
             prompt: str,
-            conversation_history: List[str],
-            depth: int,
-            node_id: int,
-            parent_id: int,
+            parent: Optional["SecurityTest.Node"],
+            node_id: Optional[int],
             scenario: str,
         ):
             self.prompt = prompt
-            self.conversation_history = conversation_history
-            self.depth = depth
+            self.parent = parent
+            self.depth = parent.depth + 1 if parent else 0
             self.node_id = node_id
-            self.parent_id = parent_id
-            self.score = None
             self.scenario = scenario
+            self.score = None
+            self.model_response = None
+            self.feedback = None
+            # Consecutive levels without improving on the parent's score
+            self.stale = 0
+            self.history_chars = self.count_history_chars()
+
+        def set_result(self, model_response: str, score: int, feedback: str):
+            self.model_response = model_response
+            self.score = score
+            self.feedback = feedback
+            parent_score = self.parent.score if self.parent else None
+            if parent_score is not None and score <= parent_score:
+                self.stale = self.parent.stale + 1
+            else:
+                self.stale = 0
+            self.history_chars = self.count_history_chars()
+
+        def count_history_chars(self) -> int:
+            # Length of the joined conversation_history, from the parent's
+            if self.parent is None:
+                return 0
+            own = len("\n".join(self.turn()))
+            if self.parent.parent is None:
+                return own
+            return self.parent.history_chars + 1 + own
+
+        @property
+        def parent_id(self) -> int:
+            return self.parent.node_id if self.parent else -1
+
+        def path(self) -> List["SecurityTest.Node"]:
+            # Nodes from the first attack below the root down to this node
+            nodes = []
+            node = self
+            while node.parent is not None:
+                nodes.append(node)
+                node = node.parent
+            return nodes[::-1]
+
+        def turn(self, max_chars: Optional[int] = None) -> List[str]:
+            # History lines contributed by this node; max_chars clips the
+            # model response and judge feedback
+            def clip(text: str) -> str:
+                if max_chars is None or len(text) <= max_chars:
+                    return text
+                return text[:max_chars] + " [...]"
+
+            lines = [self.prompt]
+            if self.score is not None:
+                lines.append(f"Model: {clip(self.model_response)}")
+                lines.append(f"Judge Score: {self.score}")
+                lines.append(f"Judge Feedback: {clip(self.feedback)}")
+            return lines
+
+        @property
+        def conversation_history(self) -> List[str]:
+            return [line for node in self.path() for line in node.turn()]
+
+        def to_dict(self) -> Dict:
+            return {
+                "node_id": self.node_id,
+                "parent_id": self.parent_id,
+                "depth": self.depth,
+                "scenario": self.scenario,
+                "prompt": self.prompt,
+                "score": self.score,
+            }
+
+        def priority(self) -> Tuple[float, int, int]:
+            # Unscored roots first, then higher judge scores, then shallower
+            score = self.score if self.score is not None else float("inf")
+            return (-score, self.depth, self.node_id)
 
         def __lt__(self, other):
-            return (
-                self.score > other.score
-                if self.score and other.score
-                else False
+            # heapq is a min-heap, so the most promising node pops first
+            return self.priority() < other.priority()
+
+    def record_stats(self, **counts: int) -> None:
+        with self.stats_lock:
+            for name, count in counts.items():
+                self.search_stats[name] += count
+
+    def record_level(self, started: float, depth: Optional[int] = None) -> None:
+        # depth of the expanded nodes; None for best-first steps that mix them
+        seconds = time.monotonic() - started
+        with self.stats_lock:
+            self.level_seconds.append(seconds)
+        record_step("attack", depth, seconds)
+
+    def stats(self) -> Dict:
+        with self.stats_lock:
+            search_stats = dict(self.search_stats)
+            level_seconds = list(self.level_seconds)
+        return {
+            "search": search_stats,
+            "level_latency": latency_summary(level_seconds),
+            "history": self.history_compactor.stats(),
+            "judge": self.judge_chain.stats(),
+            "prejudge": self.prejudge.stats(),
+        }
+
+    def emit(self, event_type: str, data: Dict) -> None:
+        record_nodes("attack", event_type, len(data.get("dropped", ())) or 1)
+        if self.on_event is not None:
+            self.on_event(event_type, data)
+
+    def emit_created(self, children: List[Node]) -> None:
+        for child in children:
+            self.emit("node_created", child.to_dict())
+
+    def emit_scored(self, children: List[Node]) -> None:
+        for child in children:
+            self.emit(
+                "node_scored",
+                {
+                    **child.to_dict(),
+                    "model_response": child.model_response,
+                    "feedback": child.feedback,
+                },
+            )
+            with self.stats_lock:
+                best = self.best_scores.get(child.scenario)
+                is_best = best is None or child.score > best
+                if is_best:
+                    self.best_scores[child.scenario] = child.score
+            if is_best:
+                self.emit("new_best", child.to_dict())
+
+    def record_timeout(self, node: Node) -> None:
+        # One of the node's LLM calls was still timing out after the
+        # gateway's last retry; the node is dropped instead of failing the
+        # search. Streamed children have no id yet and are never announced
+        log.warning("LLM call timed out, dropping node", node_id=node.node_id)
+        if node.node_id is None:
+            self.record_stats(timed_out=1)
+        else:
+            self.record_stop(node, "timed_out")
+
+    def record_stop(self, node: Node, reason: str, calls_saved: int = 0) -> None:
+        self.record_stats(**{reason: 1}, estimated_calls_saved=calls_saved)
+        self.emit(
+            "node_stopped",
+            {"node_id": node.node_id, "scenario": node.scenario, "reason": reason},
+        )
+
+    def keep_best(self, parent: Node, children: List[Node], max_width: int) -> List[Node]:
+        # Keep the max_width highest-scored children of one expansion
+        children.sort(key=lambda x: x.score, reverse=True)
+        dropped = children[max_width:]
+        if dropped:
+            self.emit(
+                "pruned",
+                {
+                    "scenario": parent.scenario,
+                    "parent_id": parent.node_id,
+                    "kept": [c.node_id for c in children[:max_width]],
+                    "dropped": [c.node_id for c in dropped],
+                },
+            )
+        return children[:max_width]
+
+    def stop_reason(self, node: Node) -> Optional[str]:
+        if node.score is None:
+            return None
+        if self.success_threshold is not None and node.score >= self.success_threshold:
+            return "stopped_success"
+        if self.prune_below is not None and node.score < self.prune_below:
+            return "pruned"
+        if self.patience is not None and node.stale >= self.patience:
+            return "stalled"
+        return None
+
+    def expansion_cost(
+        self, depth: int, branching_factor: int, max_width: int, max_depth: int
+    ) -> int:
+        # LLM calls the full subtree below a node at `depth` would have made
+        calls, nodes = 0, 1
+        for _ in range(depth, max_depth):
+            calls += nodes * (1 + 2 * branching_factor)
+            nodes *= min(branching_factor, max_width)
+        return calls
+
+    def expand_node(
+        self,
+        node: Node,
+        goal: str,
+        branching_factor: int,
+        system_prompt: str,
+        node_ids: Iterator[int],
+    ) -> List[Node]:
+        # Generate, run and judge the children of one node
+        try:
+            attack_prompts = self.generate_attack_prompts(
+                goal, self.history_compactor.compact(node), branching_factor
+            )
+        except LLMTimeout:
+            self.record_timeout(node)
+            return []
+        self.record_stats(
+            expansions=1, search_llm_calls=1 + 2 * len(attack_prompts)
+        )
+
+        children = []
+        for prompt in attack_prompts:
+            log.debug("Attack prompt", color="R", prompt=prompt)
+            children.append(self.Node(prompt, node, next(node_ids), goal))
+        self.emit_created(children)
+
+        for child in children:
+            try:
+                model_response = self.target_llm.invoke(child.prompt).content
+            except LLMTimeout:
+                self.record_timeout(child)
+                continue
+
+            verdict = self.judge_attack(goal, system_prompt, child.prompt, model_response)
+            if verdict is None:
+                self.record_timeout(child)
+                continue
+            score, feedback = verdict
+
+            log.debug(
+                "Attack judged", color="GRAY",
+                score=score, response=model_response, feedback=feedback,
             )
 
+            child.set_result(model_response, score, feedback)
+
+        children = [child for child in children if child.score is not None]
+        self.emit_scored(children)
+        return children
+
+    async def aexpand_node(
+        self,
+        node: Node,
+        goal: str,
+        branching_factor: int,
+        system_prompt: str,
+        node_ids: Iterator[int],
+        slots: Optional[asyncio.Semaphore] = None,
+    ) -> List[Node]:
+        if self.stream_generation:
+            children = await self.astream_expand(
+                node, goal, branching_factor, system_prompt,
+                slots or asyncio.Semaphore(self.max_concurrency),
+            )
+            for child in children:
+                child.node_id = next(node_ids)
+            self.emit_created(children)
+            self.emit_scored(children)
+            return children
+
+        [attack_prompts] = await self.agenerate_attack_prompts_batch(
+            goal, [self.history_compactor.compact(node)], branching_factor
+        )
+        if attack_prompts is None:
+            self.record_timeout(node)
+            return []
+        self.record_stats(
+            expansions=1, search_llm_calls=1 + 2 * len(attack_prompts)
+        )
+
+        children = []
+        for prompt in attack_prompts:
+            log.debug("Attack prompt", color="R", prompt=prompt)
+            children.append(self.Node(prompt, node, next(node_ids), goal))
+        self.emit_created(children)
+
+        await self.ascore_children(goal, system_prompt, children)
+        children = [child for child in children if child.score is not None]
+        self.emit_scored(children)
+        return children
+
+    async def ascore_children(
+        self, goal: str, system_prompt: str, children: List[Node]
+    ) -> None:
+        # Target and judge calls for all children at once; children whose
+        # calls timed out are left unscored
+        responses = await self.target_llm.abatch(
+            [child.prompt for child in children],
+            config=self.batch_config(),
+            return_exceptions=True,
+        )
+        answered = []
+        for child, response in zip(children, responses):
+            if timed_out(response):
+                self.record_timeout(child)
+            else:
+                answered.append((child, response.content))
+        judgements = await self.ajudge_attacks(
+            goal,
+            system_prompt,
+            [child.prompt for child, _ in answered],
+            [model_response for _, model_response in answered],
+        )
+
+        for (child, model_response), verdict in zip(answered, judgements):
+            if verdict is None:
+                self.record_timeout(child)
+                continue
+            score, feedback = verdict
+            log.debug(
+                "Attack judged", color="GRAY",
+                score=score, response=model_response, feedback=feedback,
+            )
+
+            child.set_result(model_response, score, feedback)
+
+    async def astream_expand(
+        self,
+        node: Node,
+        goal: str,
+        branching_factor: int,
+        system_prompt: str,
+        slots: asyncio.Semaphore,
+    ) -> List[Node]:
+        """Expand a node from the streamed attacker reply.
+
+        Each attack prompt is sent to the target and the judge as soon as its
+        closing delimiter arrives, while the attacker is still writing the
+        rest. `slots` bounds the target and judge calls in flight. Children
+        come back in generation order without ids; the caller numbers them.
+        """
+        children = []
+        tasks = []
+
+        async def evaluate(child: "SecurityTest.Node"):
+            async with slots:
+                try:
+                    model_response = (await self.target_llm.ainvoke(child.prompt)).content
+                except LLMTimeout:
+                    self.record_timeout(child)
+                    return
+                [verdict] = await self.ajudge_attacks(
+                    goal, system_prompt, [child.prompt], [model_response]
+                )
+            if verdict is None:
+                self.record_timeout(child)
+                return
+            score, feedback = verdict
+
+            log.debug(
+                "Attack judged", color="GRAY",
+                score=score, response=model_response, feedback=feedback,
+            )
+
+            child.set_result(model_response, score, feedback)
+
+        chunks = self.attacker_chain.astream(
+            {
+                "attack_scenario": goal,
+                "branch_history": self.history_compactor.compact(node),
+                "num_branches": branching_factor,
+            }
+        )
+        try:
+            try:
+                async for prompt in aiter_prompt_blocks(chunks):
+                    log.debug("Attack prompt", color="R", prompt=prompt)
+                    child = self.Node(prompt, node, None, goal)
+                    children.append(child)
+                    tasks.append(asyncio.create_task(evaluate(child)))
+            except LLMTimeout:
+                # The attacker stalled; prompts it already finished still count
+                self.record_timeout(node)
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+        self.record_stats(expansions=1, search_llm_calls=1 + 2 * len(children))
+        return [child for child in children if child.score is not None]
+
     def tap_algorithm(
         self,
         goal: str,
@@ -131,13 +675,16 @@ class SecurityTest:
         max_depth: int,
         system_prompt: str,
     ) -> List[Node]:
-        node_counter = 0
-        root = self.Node(goal, [], 0, node_counter, -1, goal)
+        node_ids = itertools.count(1)
+        root = self.Node(goal, None, 0, goal)
         queue = deque([root])
-        all_nodes = {0: root}
         all_leaf_nodes = []
 
-        colored_print(f"Attack Scenario: {goal}", "B")
+        log.info("Attack scenario", color="B", scenario=goal)
+
+        # Depth at which a successful attack was found; nothing at or below
+        # it is expanded, which ends the scenario after the current level
+        solved_depth = float("inf")
 
         while queue:
             node = queue.popleft()
@@ -146,69 +693,420 @@ class SecurityTest:
                 all_leaf_nodes.append(node)
                 continue
 
-            attack_prompts = self.generate_attack_prompts(
-                goal, "\n".join(node.conversation_history), branching_factor
-            )
+            reason = "stopped_success" if node.depth >= solved_depth else self.stop_reason(node)
+            if reason:
+                all_leaf_nodes.append(node)
+                self.record_stop(
+                    node,
+                    reason,
+                    self.expansion_cost(node.depth, branching_factor, max_width, max_depth),
+                )
+                continue
+
+            started = time.monotonic()
+            with node_labels(goal, node.depth), self.expand_span(node) as trace:
+                children = self.expand_node(
+                    node, goal, branching_factor, system_prompt, node_ids
+                )
+                trace.set(**self.children_attrs(children))
+            self.record_level(started, node.depth)
 
+            if any(self.stop_reason(c) == "stopped_success" for c in children):
+                solved_depth = min(solved_depth, node.depth + 1)
+
+            queue.extend(self.keep_best(node, children, max_width))
+
+        return all_leaf_nodes
+
+    async def atap_algorithm(
+        self,
+        goal: str,
+        branching_factor: int,
+        max_width: int,
+        max_depth: int,
+        system_prompt: str,
+    ) -> List[Node]:
+        """Async counterpart of tap_algorithm that expands one level at a time.
+
+        All attacker calls of a level run together, then all target calls,
+        then all judge calls. With stream_generation the target and judge
+        calls of a prompt start while the attacker is still writing. Node ids,
+        pruning and the returned leaves are identical to the sequential
+        version either way.
+        """
+        node_ids = itertools.count(1)
+        root = self.Node(goal, None, 0, goal)
+        frontier = [root]
+        all_leaf_nodes = []
+
+        log.info("Attack scenario", color="B", scenario=goal)
+
+        solved = False
+
+        while frontier:
+            expandable = []
+            for node in frontier:
+                if node.depth >= max_depth:
+                    all_leaf_nodes.append(node)
+                    continue
+                reason = "stopped_success" if solved else self.stop_reason(node)
+                if reason:
+                    all_leaf_nodes.append(node)
+                    self.record_stop(
+                        node,
+                        reason,
+                        self.expansion_cost(node.depth, branching_factor, max_width, max_depth),
+                    )
+                    continue
+                expandable.append(node)
+            if not expandable:
+                break
+
+            # Every node of a level has the same depth
+            depth = expandable[0].depth
+            started = time.monotonic()
+            with node_labels(goal, depth), span("level", depth=depth, nodes=len(expandable)):
+                if self.stream_generation:
+                    families = await self.astream_level(
+                        expandable, goal, branching_factor, system_prompt, node_ids
+                    )
+                else:
+                    families = await self.abatch_level(
+                        expandable, goal, branching_factor, system_prompt, node_ids
+                    )
+            self.record_level(started, depth)
+            level = [child for children in families for child in children]
+
+            solved = any(self.stop_reason(c) == "stopped_success" for c in level)
+
+            frontier = []
+            for node, children in zip(expandable, families):
+                frontier.extend(self.keep_best(node, children, max_width))
+
+        return all_leaf_nodes
+
+    async def abatch_level(
+        self,
+        expandable: List[Node],
+        goal: str,
+        branching_factor: int,
+        system_prompt: str,
+        node_ids: Iterator[int],
+    ) -> List[List[Node]]:
+        prompt_lists = await self.agenerate_attack_prompts_batch(
+            goal,
+            [self.history_compactor.compact(n) for n in expandable],
+            branching_factor,
+        )
+
+        families = []
+        for node, attack_prompts in zip(expandable, prompt_lists):
+            if attack_prompts is None:
+                self.record_timeout(node)
+                attack_prompts = []
             children = []
             for prompt in attack_prompts:
-                colored_print(f"Attack Prompt: {prompt}", "R")
-                node_counter += 1
-                child = self.Node(
-                    prompt,
-                    node.conversation_history + [prompt],
-                    node.depth + 1,
-                    node_counter,
-                    node.node_id,
-                    goal,
-                )
-                children.append(child)
-                all_nodes[node_counter] = child
+                log.debug("Attack prompt", color="R", prompt=prompt)
+                children.append(self.Node(prompt, node, next(node_ids), goal))
+            families.append(children)
 
-            for child in children:
-                model_response = self.llm.invoke(child.prompt).content
+        level = [child for children in families for child in children]
+        self.emit_created(level)
+        self.record_stats(
+            expansions=len(expandable),
+            search_llm_calls=len(expandable) + 2 * len(level),
+        )
+        await self.ascore_children(goal, system_prompt, level)
 
-                colored_print(f"Model Response: {model_response}", "GRAY")
+        families = [
+            [child for child in children if child.score is not None] for children in families
+        ]
+        self.emit_scored([child for children in families for child in children])
+        return families
 
-                score, feedback = self.judge_attack(
-                    goal, system_prompt, child.prompt, model_response
+    async def astream_level(
+        self,
+        expandable: List[Node],
+        goal: str,
+        branching_factor: int,
+        system_prompt: str,
+        node_ids: Iterator[int],
+    ) -> List[List[Node]]:
+        slots = asyncio.Semaphore(self.max_concurrency)
+        families = await asyncio.gather(
+            *(
+                self.alabeled_expand(
+                    node, self.astream_expand(node, goal, branching_factor, system_prompt, slots)
                 )
+                for node in expandable
+            )
+        )
+        # Number children in parent order, exactly like the batched level
+        for children in families:
+            for child in children:
+                child.node_id = next(node_ids)
+            self.emit_created(children)
+            self.emit_scored(children)
+        return list(families)
 
-                colored_print(f"Judge Score: {score}", "G")
-                colored_print(f"Judge Feedback: {feedback}", "G")
+    def best_first_search(self, attack_scenarios: List[str]) -> List[List[Node]]:
+        """Expand the most promising node across all scenarios until the
+        call budget runs out. Returns every scored node, grouped by scenario.
+        """
+        frontier = []
+        node_ids = [itertools.count(1) for _ in attack_scenarios]
+        scored_nodes = [[] for _ in attack_scenarios]
+        solved = [False] * len(attack_scenarios)
+        expansion_cost = 1 + 2 * self.branching_factor
+        spent = 0
 
-                child.score = score
-                child.conversation_history.append(f"Model: {model_response}")
-                child.conversation_history.append(f"Judge Score: {score}")
-                child.conversation_history.append(
-                    f"Judge Feedback: {feedback}"
+        for index, scenario in enumerate(attack_scenarios):
+            log.info("Attack scenario", color="B", scenario=scenario)
+            heapq.heappush(frontier, (self.Node(scenario, None, 0, scenario), index))
+
+        while frontier:
+            if self.call_budget is not None and spent + expansion_cost > self.call_budget:
+                break
+            node, index = heapq.heappop(frontier)
+            if not self.should_expand(node, solved[index]):
+                continue
+
+            started = time.monotonic()
+            with node_labels(node.scenario, node.depth), self.expand_span(node) as trace:
+                children = self.expand_node(
+                    node, node.scenario, self.branching_factor, self.system_prompt,
+                    node_ids[index],
                 )
+                trace.set(**self.children_attrs(children))
+            self.record_level(started, node.depth)
+            spent += 1 + 2 * len(children)
+            self.push_children(frontier, scored_nodes, solved, index, node, children)
 
-            children.sort(key=lambda x: x.score, reverse=True)
-            children = children[:max_width]
+        self.record_stats(unexpanded_frontier=len(frontier))
+        return scored_nodes
 
-            queue.extend(children)
+    async def abest_first_search(self, attack_scenarios: List[str]) -> List[List[Node]]:
+        """Async best_first_search that expands the top frontier_batch_size
+        nodes of the shared frontier concurrently at each step.
+        """
+        frontier = []
+        node_ids = [itertools.count(1) for _ in attack_scenarios]
+        scored_nodes = [[] for _ in attack_scenarios]
+        solved = [False] * len(attack_scenarios)
+        expansion_cost = 1 + 2 * self.branching_factor
+        spent = 0
+        slots = asyncio.Semaphore(self.max_concurrency)
 
-        return all_leaf_nodes
+        for index, scenario in enumerate(attack_scenarios):
+            log.info("Attack scenario", color="B", scenario=scenario)
+            heapq.heappush(frontier, (self.Node(scenario, None, 0, scenario), index))
 
-    def run(self) -> List[Tuple[str, str, int]]:
-        all_top_nodes = []
-        attack_scenarios = self.generate_attack_scenarios()
+        while frontier:
+            batch = []
+            while frontier and len(batch) < self.frontier_batch_size:
+                reserved = spent + expansion_cost * (len(batch) + 1)
+                if self.call_budget is not None and reserved > self.call_budget:
+                    break
+                node, index = heapq.heappop(frontier)
+                if self.should_expand(node, solved[index]):
+                    batch.append((node, index))
+            if not batch:
+                break
 
-        for scenario in attack_scenarios:
-            leaf_nodes = self.tap_algorithm(
-                scenario, self.branching_factor, self.max_width, self.max_depth, self.system_prompt
-            )
-            all_top_nodes.extend(leaf_nodes)
+            started = time.monotonic()
+            with span("step", nodes=len(batch)):
+                expanded = await asyncio.gather(
+                    *(
+                        self.alabeled_expand(
+                            node,
+                            self.aexpand_node(
+                                node, node.scenario, self.branching_factor,
+                                self.system_prompt, node_ids[index], slots,
+                            ),
+                        )
+                        for node, index in batch
+                    )
+                )
+            depths = {node.depth for node, _ in batch}
+            self.record_level(started, depths.pop() if len(depths) == 1 else None)
+            for (node, index), children in zip(batch, expanded):
+                spent += 1 + 2 * len(children)
+                self.push_children(frontier, scored_nodes, solved, index, node, children)
+
+        self.record_stats(unexpanded_frontier=len(frontier))
+        return scored_nodes
+
+    async def alabeled_expand(self, node: Node, expansion: Awaitable[List[Node]]) -> List[Node]:
+        # Await one node's expansion with its scenario and depth on the LLM
+        # metrics and its own span in the trace
+        with node_labels(node.scenario, node.depth), self.expand_span(node) as trace:
+            children = await expansion
+            trace.set(**self.children_attrs(children))
+        return children
 
-        top_k_nodes = heapq.nlargest(
-            self.top_k,
-            all_top_nodes,
-            key=lambda x: x.score if x.score else float("-inf"),
+    def expand_span(self, node: Node):
+        return span(
+            "expand",
+            scenario=node.scenario,
+            node_id=node.node_id,
+            parent_node=node.parent_id,
+            depth=node.depth,
+            score=node.score,
         )
 
+    def children_attrs(self, children: List[Node]) -> Dict:
+        # Streamed children are numbered after the whole level is done
+        return {
+            "children": [c.node_id for c in children],
+            "scores": [c.score for c in children],
+        }
+
+    def should_expand(self, node: Node, scenario_solved: bool) -> bool:
+        if node.depth >= self.max_depth:
+            return False
+        reason = "stopped_success" if scenario_solved else self.stop_reason(node)
+        if reason:
+            self.record_stop(node, reason)
+            return False
+        return True
+
+    def push_children(
+        self,
+        frontier: List[Tuple],
+        scored_nodes: List[List[Node]],
+        solved: List[bool],
+        index: int,
+        parent: Node,
+        children: List[Node],
+    ) -> None:
+        scored_nodes[index].extend(children)
+        if any(self.stop_reason(c) == "stopped_success" for c in children):
+            solved[index] = True
+        for child in self.keep_best(parent, children, self.max_width):
+            heapq.heappush(frontier, (child, index))
+
+    def merge_top_k(
+        self, heap: List[Tuple], scenario_index: int, leaf_nodes: List[Node]
+    ) -> None:
+        """Fold one finished tree into the running top-k min-heap.
+
+        Entries carry (scenario_index, leaf_index) as a tie-breaker so the
+        final order matches heapq.nlargest over the concatenated leaves,
+        regardless of which tree finished first.
+        """
+        if self.top_k <= 0:
+            return
+        for leaf_index, node in enumerate(leaf_nodes):
+            entry = (
+                node.score if node.score else float("-inf"),
+                -scenario_index,
+                -leaf_index,
+                node,
+            )
+            if len(heap) < self.top_k:
+                heapq.heappush(heap, entry)
+            elif entry[:3] > heap[0][:3]:
+                heapq.heapreplace(heap, entry)
+
+    def top_k_results(self, heap: List[Tuple]) -> List[Tuple[str, str, int]]:
+        top_k_nodes = [entry[-1] for entry in sorted(heap, reverse=True)]
         return [(node.scenario, node.prompt, node.score) for node in top_k_nodes]
 
+    def collect_trees(
+        self,
+        top_k_heap: List[Tuple],
+        attack_scenarios: List[str],
+        trees: List[List[Node]],
+        on_tree_complete: Optional[Callable[[int, str, List[Node]], None]],
+    ) -> List[Tuple[str, str, int]]:
+        for index, nodes in enumerate(trees):
+            if on_tree_complete:
+                on_tree_complete(index, attack_scenarios[index], nodes)
+            self.merge_top_k(top_k_heap, index, nodes)
+        return self.top_k_results(top_k_heap)
+
+    def run_scenario(self, scenario: str) -> List[Node]:
+        with span("scenario", scenario=scenario):
+            return self.tap_algorithm(
+                scenario, self.branching_factor, self.max_width, self.max_depth,
+                self.system_prompt,
+            )
+
+    async def arun_scenario(self, scenario: str) -> List[Node]:
+        with span("scenario", scenario=scenario):
+            return await self.atap_algorithm(
+                scenario, self.branching_factor, self.max_width, self.max_depth,
+                self.system_prompt,
+            )
+
+    def run(
+        self,
+        on_tree_complete: Optional[Callable[[int, str, List[Node]], None]] = None,
+    ) -> List[Tuple[str, str, int]]:
+        top_k_heap = []
+        attack_scenarios = self.generate_attack_scenarios()
+        if not attack_scenarios:
+            return []
+
+        if self.search_mode == "best_first":
+            trees = self.best_first_search(attack_scenarios)
+            return self.collect_trees(top_k_heap, attack_scenarios, trees, on_tree_complete)
+
+        # Scenario trees are independent, so search them side by side
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_parallel_scenarios, len(attack_scenarios))
+        ) as executor:
+            # Worker threads see the caller's metrics collector
+            futures = {
+                executor.submit(
+                    contextvars.copy_context().run, self.run_scenario, scenario
+                ): index
+                for index, scenario in enumerate(attack_scenarios)
+            }
+            for future in as_completed(futures):
+                index = futures[future]
+                leaf_nodes = future.result()
+                if on_tree_complete:
+                    on_tree_complete(index, attack_scenarios[index], leaf_nodes)
+                self.merge_top_k(top_k_heap, index, leaf_nodes)
+
+        return self.top_k_results(top_k_heap)
+
+    async def arun(
+        self,
+        on_tree_complete: Optional[Callable[[int, str, List[Node]], None]] = None,
+    ) -> List[Tuple[str, str, int]]:
+        top_k_heap = []
+        attack_scenarios = await self.agenerate_attack_scenarios()
+
+        if self.search_mode == "best_first":
+            trees = await self.abest_first_search(attack_scenarios)
+            return self.collect_trees(top_k_heap, attack_scenarios, trees, on_tree_complete)
+
+        slots = asyncio.Semaphore(self.max_parallel_scenarios)
+
+        async def search(index: int, scenario: str):
+            async with slots:
+                leaf_nodes = await self.arun_scenario(scenario)
+            return index, leaf_nodes
+
+        # Levels of different scenario trees interleave on the event loop
+        tasks = [
+            asyncio.create_task(search(index, scenario))
+            for index, scenario in enumerate(attack_scenarios)
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                index, leaf_nodes = await next_done
+                if on_tree_complete:
+                    on_tree_complete(index, attack_scenarios[index], leaf_nodes)
+                self.merge_top_k(top_k_heap, index, leaf_nodes)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        return self.top_k_results(top_k_heap)
+
 
 # Example usage
 if __name__ == "__main__":
@@ -0,0 +1,95 @@
+import threading
+from typing import Dict, List, Optional
+
+STRATEGIES = ("full", "last_n", "best_scored")
+
+
+def estimate_tokens(text: str) -> int:
+    return chars_to_tokens(len(text))
+
+
+def chars_to_tokens(chars: int) -> int:
+    # Rough count for Mistral tokenizers: about four characters per token
+    return (chars + 3) // 4
+
+
+class HistoryCompactor:
+    """Builds the ``branch_history`` text sent to the attacker chain.
+
+    strategy:
+        "full"         every turn on the path from the root (original behaviour)
+        "last_n"       only the last ``max_turns`` turns
+        "best_scored"  the ``max_turns`` highest-scored turns, kept in path order
+    max_response_chars clips each model response and judge feedback, and
+    max_tokens drops the oldest remaining turns until the estimate fits
+    (the most recent turn is always kept).
+    """
+
+    def __init__(
+        self,
+        strategy: str = "full",
+        max_turns: int = 3,
+        max_response_chars: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+    ):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown history strategy {strategy!r}, expected one of {STRATEGIES}")
+        self.strategy = strategy
+        self.max_turns = max_turns
+        self.max_response_chars = max_response_chars
+        self.max_tokens = max_tokens
+
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.tokens_full = 0
+        self.tokens_sent = 0
+        self.last_tokens_saved = 0
+
+    def select_turns(self, path: List) -> List:
+        if self.strategy == "last_n":
+            return path[-self.max_turns:] if self.max_turns > 0 else []
+        if self.strategy == "best_scored":
+            ranked = sorted(
+                range(len(path)),
+                key=lambda i: (path[i].score if path[i].score is not None else -1, i),
+                reverse=True,
+            )
+            keep = sorted(ranked[: self.max_turns])
+            return [path[i] for i in keep]
+        return path
+
+    def compact(self, node) -> str:
+        path = node.path()
+        turns = [
+            "\n".join(n.turn(self.max_response_chars)) for n in self.select_turns(path)
+        ]
+        # Joined length without building the text: turns plus separators
+        chars = sum(len(turn) for turn in turns) + max(0, len(turns) - 1)
+        start = 0
+        if self.max_tokens is not None:
+            while len(turns) - start > 1 and chars_to_tokens(chars) > self.max_tokens:
+                chars -= len(turns[start]) + 1
+                start += 1
+        history = "\n".join(turns[start:])
+
+        full_tokens = chars_to_tokens(node.history_chars)
+        sent_tokens = chars_to_tokens(chars)
+        with self.lock:
+            self.calls += 1
+            self.tokens_full += full_tokens
+            self.tokens_sent += sent_tokens
+            self.last_tokens_saved = full_tokens - sent_tokens
+        return history
+
+    def stats(self) -> Dict:
+        with self.lock:
+            saved = self.tokens_full - self.tokens_sent
+            return {
+                "strategy": self.strategy,
+                "calls": self.calls,
+                "history_tokens_full": self.tokens_full,
+                "history_tokens_sent": self.tokens_sent,
+                "history_tokens_saved": saved,
+                "tokens_saved_per_call": saved / self.calls if self.calls else 0.0,
+                "last_call_tokens_saved": self.last_tokens_saved,
+            }
@@ -0,0 +1,288 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, List, Optional
+
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage
+from langchain_core.messages.utils import convert_to_messages
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from llm_cache import llm_cache, model_name
+
+CASSETTE_MODES = ("record", "replay")
+
+
+class CassetteMiss(KeyError):
+    """Replay got a request the cassette has no response for."""
+
+
+def prompt_messages(input: Any) -> List[BaseMessage]:
+    # Chains hand the model a prompt value, raw target calls a plain string
+    if hasattr(input, "to_messages"):
+        return input.to_messages()
+    if isinstance(input, str):
+        return [HumanMessage(content=input)]
+    return convert_to_messages(input)
+
+
+class Cassette:
+    """Append-only log of LLM requests and responses, one JSON object per line.
+
+    Each entry holds the request key, the prompt messages, the reply with
+    its token usage, when the request started relative to the first one,
+    and how long it took (and, for streams, how long until the first chunk
+    and how many chunks there were). In replay mode the file is loaded once.
+    Requests are matched on their key, and repeated requests get the
+    recorded replies in recorded order.
+    """
+
+    def __init__(self, path: str, mode: str = "record", speed: float = 0.0):
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"Unknown cassette mode {mode!r}, expected one of {CASSETTE_MODES}")
+        self.path = path
+        self.mode = mode
+        # Replay delay is the recorded latency divided by speed; 0 skips it
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.started: Optional[float] = None
+        self.file = None
+        self.entries: Dict[str, Deque[Dict]] = defaultdict(deque)
+        self.last: Dict[str, Dict] = {}
+        self.model = "cassette"
+        self.counters = {"recorded": 0, "replayed": 0, "misses": 0}
+        if mode == "replay":
+            self.load()
+
+    @staticmethod
+    def make_key(model: str, messages: List[BaseMessage]) -> str:
+        payload = json.dumps(
+            {"model": model, "messages": [[m.type, m.content] for m in messages]},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def load(self) -> None:
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                self.entries[entry["key"]].append(entry)
+                self.model = entry["model"]
+
+    def record(self, entry: Dict) -> None:
+        line = json.dumps(entry, separators=(",", ":"), default=str)
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, "a", encoding="utf-8")
+            self.file.write(line + "\n")
+            self.file.flush()
+            self.counters["recorded"] += 1
+
+    def elapsed(self, now: float) -> float:
+        with self.lock:
+            if self.started is None:
+                self.started = now
+            return now - self.started
+
+    def replay(self, key: str) -> Optional[Dict]:
+        # Once a request's recorded replies run out its last one is reused
+        with self.lock:
+            queue = self.entries.get(key)
+            if queue:
+                self.last[key] = queue.popleft()
+            entry = self.last.get(key)
+            self.counters["replayed" if entry else "misses"] += 1
+            return entry
+
+    def delay(self, seconds: float) -> float:
+        return seconds / self.speed if self.speed else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            stats = dict(self.counters)
+        stats.update(path=self.path, mode=self.mode, speed=self.speed)
+        return stats
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class CassetteModel(Runnable):
+    """A chat model that records its traffic to a Cassette, or replays it.
+
+    It sits under the LLM gateway, so it sees every attempt the gateway
+    makes. When recording, only successful replies are written; failed
+    attempts and retries stay live-only. A replay miss goes to `fallback`
+    if one is given and raises CassetteMiss otherwise. The LLM response
+    cache is turned off while a cassette is configured, so every request
+    reaches it.
+    """
+
+    def __init__(
+        self,
+        cassette: Cassette,
+        model: Optional[Runnable] = None,
+        fallback: Optional[Runnable] = None,
+    ):
+        self.cassette = cassette
+        self.runnable = model
+        self.fallback = fallback
+        self.model = model_name(model) if model is not None else cassette.model
+
+    def request(self, input: Any) -> tuple:
+        messages = prompt_messages(input)
+        return messages, self.cassette.make_key(self.model, messages)
+
+    def record(self, key: str, messages: List[BaseMessage], started: float, **fields: Any) -> None:
+        self.cassette.record(
+            {
+                "key": key,
+                "model": self.model,
+                "at": round(self.cassette.elapsed(started), 4),
+                "latency": round(time.monotonic() - started, 4),
+                "messages": [[m.type, m.content] for m in messages],
+                **fields,
+            }
+        )
+
+    def miss(self, key: str) -> Runnable:
+        if self.fallback is None:
+            raise CassetteMiss(f"No recorded response for request {key[:12]}")
+        return self.fallback
+
+    @staticmethod
+    def replayed(entry: Dict) -> AIMessage:
+        return AIMessage(content=entry["content"], usage_metadata=entry.get("usage"))
+
+    @staticmethod
+    def split(entry: Dict) -> List[str]:
+        # Cut the reply into as many chunks as were streamed when recording
+        content = entry["content"]
+        count = max(1, entry.get("chunks", 1))
+        size = max(1, -(-len(content) // count))
+        return [content[i : i + size] for i in range(0, len(content), size)] or [""]
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> AIMessage:
+        messages, key = self.request(input)
+        if self.cassette.mode == "replay":
+            entry = self.cassette.replay(key)
+            if entry is None:
+                return self.miss(key).invoke(input, config, **kwargs)
+            time.sleep(self.cassette.delay(entry["latency"]))
+            return self.replayed(entry)
+
+        started = time.monotonic()
+        response = self.runnable.invoke(input, config, **kwargs)
+        self.record(
+            key, messages, started, content=response.content, usage=response.usage_metadata
+        )
+        return response
+
+    async def ainvoke(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AIMessage:
+        messages, key = self.request(input)
+        if self.cassette.mode == "replay":
+            entry = self.cassette.replay(key)
+            if entry is None:
+                return await self.miss(key).ainvoke(input, config, **kwargs)
+            await asyncio.sleep(self.cassette.delay(entry["latency"]))
+            return self.replayed(entry)
+
+        started = time.monotonic()
+        response = await self.runnable.ainvoke(input, config, **kwargs)
+        self.record(
+            key, messages, started, content=response.content, usage=response.usage_metadata
+        )
+        return response
+
+    def stream(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> Iterator[AIMessageChunk]:
+        messages, key = self.request(input)
+        if self.cassette.mode == "replay":
+            entry = self.cassette.replay(key)
+            if entry is None:
+                yield from self.miss(key).stream(input, config, **kwargs)
+                return
+            parts = self.split(entry)
+            first_chunk = entry.get("first_chunk", entry["latency"])
+            time.sleep(self.cassette.delay(first_chunk))
+            for i, part in enumerate(parts):
+                if i:
+                    time.sleep(self.cassette.delay(entry["latency"] - first_chunk) / (len(parts) - 1))
+                yield AIMessageChunk(content=part)
+            return
+
+        started = time.monotonic()
+        parts, first_chunk = [], None
+        for chunk in self.runnable.stream(input, config, **kwargs):
+            if first_chunk is None:
+                first_chunk = round(time.monotonic() - started, 4)
+            parts.append(chunk.content)
+            yield chunk
+        # Only complete streams are recorded
+        self.record(
+            key, messages, started,
+            content="".join(parts), chunks=len(parts), first_chunk=first_chunk,
+        )
+
+    async def astream(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AsyncIterator[AIMessageChunk]:
+        messages, key = self.request(input)
+        if self.cassette.mode == "replay":
+            entry = self.cassette.replay(key)
+            if entry is None:
+                async for chunk in self.miss(key).astream(input, config, **kwargs):
+                    yield chunk
+                return
+            parts = self.split(entry)
+            first_chunk = entry.get("first_chunk", entry["latency"])
+            await asyncio.sleep(self.cassette.delay(first_chunk))
+            for i, part in enumerate(parts):
+                if i:
+                    await asyncio.sleep(
+                        self.cassette.delay(entry["latency"] - first_chunk) / (len(parts) - 1)
+                    )
+                yield AIMessageChunk(content=part)
+            return
+
+        started = time.monotonic()
+        parts, first_chunk = [], None
+        async for chunk in self.runnable.astream(input, config, **kwargs):
+            if first_chunk is None:
+                first_chunk = round(time.monotonic() - started, 4)
+            parts.append(chunk.content)
+            yield chunk
+        self.record(
+            key, messages, started,
+            content="".join(parts), chunks=len(parts), first_chunk=first_chunk,
+        )
+
+
+def cassette_from_env() -> Optional[Cassette]:
+    path = os.environ.get("LLM_CASSETTE")
+    if not path:
+        return None
+    return Cassette(
+        path,
+        mode=os.environ.get("LLM_CASSETTE_MODE", "record"),
+        speed=float(os.environ.get("LLM_CASSETTE_SPEED", "0")),
+    )
+
+
+llm_cassette = cassette_from_env()
+if llm_cassette is not None:
+    # The response cache sits above the cassette, so its hits would never
+    # be recorded, and on replay they would skip entries the recording made
+    llm_cache.enabled = False
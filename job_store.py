@@ -0,0 +1,428 @@
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from structured_log import get_logger
+
+log = get_logger("job_store")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    system_prompt TEXT NOT NULL,
+    status TEXT NOT NULL,
+    params TEXT,
+    scenarios TEXT,
+    result TEXT,
+    error TEXT,
+    input_hash TEXT,
+    owner TEXT,
+    heartbeat_at REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_lookup ON jobs (kind, system_prompt, created_at);
+CREATE INDEX IF NOT EXISTS jobs_age ON jobs (updated_at);
+CREATE TABLE IF NOT EXISTS trees (
+    job_id TEXT NOT NULL REFERENCES jobs (id) ON DELETE CASCADE,
+    scenario_index INTEGER NOT NULL,
+    scenario TEXT NOT NULL,
+    nodes TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (job_id, scenario_index)
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL REFERENCES jobs (id) ON DELETE CASCADE,
+    type TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_by_job ON events (job_id, id);
+"""
+
+FINAL_STATUSES = ("done", "failed")
+
+JSON_FIELDS = ("params", "scenarios", "result")
+
+
+def canonical_hash(params: Dict) -> str:
+    # Same inputs, in any key order, give the same hash
+    payload = json.dumps(params, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class JobStore:
+    """SQLite-backed store for security test jobs.
+
+    Every operation opens its own connection, so the store can be shared by
+    worker threads and by several uvicorn worker processes pointing at the
+    same file. Finished jobs expire after ``ttl_seconds`` and the table is
+    capped at ``max_jobs`` rows by dropping the oldest finished jobs;
+    pending and running jobs are never evicted.
+
+    Progress is kept as an append-only event log per job. Event ids grow
+    monotonically, so a client resumes a stream by passing the last id it
+    saw. Status changes are logged as "status" events automatically.
+
+    Jobs remember a canonical hash of their input so identical requests can
+    be attached to the job that is already running, or already done.
+
+    Unfinished jobs hold a lease: the process that created them refreshes
+    ``heartbeat_at`` through heartbeat() while it is alive. A pending or
+    running job whose lease is older than ``lease_seconds`` belonged to a
+    process that crashed or restarted; it is marked failed instead of being
+    joined by new requests.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float, max_jobs: int, lease_seconds: float = 30.0):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_jobs = max_jobs
+        self.lease_seconds = lease_seconds
+        # Identifies the jobs this process keeps alive
+        self.owner = uuid.uuid4().hex
+        # Called with the ids of evicted jobs, for data kept outside the store
+        self.evict_listeners: List[Callable[[List[str]], None]] = []
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            # Stores created before input hashes and leases were recorded
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "input_hash" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN input_hash TEXT")
+            for name, kind in (("owner", "TEXT"), ("heartbeat_at", "REAL")):
+                if name not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {kind}")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_by_input ON jobs (kind, input_hash, created_at)"
+            )
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA foreign_keys=ON")
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def create_job(self, kind: str, system_prompt: str, params: Dict) -> str:
+        with self.connect() as conn:
+            job_id = self.insert_job(conn, kind, system_prompt, params)
+        self.evict()
+        return job_id
+
+    def claim_job(self, kind: str, system_prompt: str, params: Dict) -> Tuple[str, bool]:
+        """Return (job_id, created) for these inputs.
+
+        An unexpired job with the same kind and input hash that has not
+        failed is reused; otherwise a new job is created. Unfinished jobs
+        whose lease ran out are failed first, so they are never reused. The
+        lookup and insert share one write transaction, so concurrent
+        identical requests, even from other processes, end up on the same job.
+        """
+        input_hash = canonical_hash(params)
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self.fail_stale(conn)
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE kind = ? AND input_hash = ?"
+                " AND status != 'failed' AND (status != 'done' OR updated_at >= ?)"
+                " ORDER BY created_at DESC LIMIT 1",
+                (kind, input_hash, time.time() - self.ttl_seconds),
+            ).fetchone()
+            if row is not None:
+                return row["id"], False
+            job_id = self.insert_job(conn, kind, system_prompt, params, input_hash)
+        self.evict()
+        return job_id, True
+
+    def insert_job(
+        self,
+        conn: sqlite3.Connection,
+        kind: str,
+        system_prompt: str,
+        params: Dict,
+        input_hash: Optional[str] = None,
+    ) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        conn.execute(
+            "INSERT INTO jobs (id, kind, system_prompt, status, params, input_hash,"
+            " owner, heartbeat_at, created_at, updated_at)"
+            " VALUES (?, ?, ?, 'pending', ?, ?, ?, ?, ?, ?)",
+            (
+                job_id, kind, system_prompt, json.dumps(params), input_hash,
+                self.owner, now, now, now,
+            ),
+        )
+        self.insert_event(conn, job_id, "status", {"status": "pending"})
+        return job_id
+
+    def update_job(self, job_id: str, **fields: Any) -> None:
+        if not fields:
+            return
+        for name in JSON_FIELDS:
+            if name in fields:
+                fields[name] = json.dumps(fields[name])
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self.connect() as conn:
+            conn.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ?",
+                (*fields.values(), job_id),
+            )
+            if "status" in fields:
+                status = {"status": fields["status"]}
+                if fields.get("error") is not None:
+                    status["error"] = fields["error"]
+                self.insert_event(conn, job_id, "status", status)
+
+    def heartbeat(self) -> int:
+        """Renew the leases of this process's unfinished jobs and fail the
+        jobs of processes that stopped renewing theirs. Returns the number
+        of jobs failed."""
+        with self.connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE owner = ? AND status NOT IN (?, ?)",
+                (time.time(), self.owner, *FINAL_STATUSES),
+            )
+            return self.fail_stale(conn)
+
+    def fail_stale(self, conn: sqlite3.Connection) -> int:
+        # Jobs stored before leases existed fall back to their last update
+        now = time.time()
+        rows = conn.execute(
+            "SELECT id FROM jobs WHERE status NOT IN (?, ?)"
+            " AND COALESCE(heartbeat_at, updated_at) < ?",
+            (*FINAL_STATUSES, now - self.lease_seconds),
+        ).fetchall()
+        error = "The worker running this job stopped before it finished."
+        for row in rows:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ?",
+                (error, now, row["id"]),
+            )
+            self.insert_event(conn, row["id"], "status", {"status": "failed", "error": error})
+        return len(rows)
+
+    def delete_job(self, job_id: str) -> None:
+        with self.connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def add_tree(
+        self, job_id: str, scenario_index: int, scenario: str, nodes: List[Dict]
+    ) -> None:
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO trees (job_id, scenario_index, scenario, nodes, created_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (job_id, scenario_index, scenario, json.dumps(nodes), time.time()),
+            )
+
+    def write_batch(self, items: List[Tuple]) -> None:
+        # ("tree", job_id, scenario_index, scenario, nodes) or
+        # ("event", job_id, type, data), written in order in one transaction
+        with self.connect() as conn:
+            for item in items:
+                if item[0] == "tree":
+                    _, job_id, scenario_index, scenario, nodes = item
+                    conn.execute(
+                        "INSERT OR REPLACE INTO trees"
+                        " (job_id, scenario_index, scenario, nodes, created_at)"
+                        " VALUES (?, ?, ?, ?, ?)",
+                        (job_id, scenario_index, scenario, json.dumps(nodes), time.time()),
+                    )
+                else:
+                    _, job_id, event_type, data = item
+                    self.insert_event(conn, job_id, event_type, data)
+
+    def add_event(self, job_id: str, event_type: str, data: Dict) -> int:
+        with self.connect() as conn:
+            return self.insert_event(conn, job_id, event_type, data)
+
+    def insert_event(
+        self, conn: sqlite3.Connection, job_id: str, event_type: str, data: Dict
+    ) -> int:
+        cursor = conn.execute(
+            "INSERT INTO events (job_id, type, data, created_at) VALUES (?, ?, ?, ?)",
+            (job_id, event_type, json.dumps(data), time.time()),
+        )
+        return cursor.lastrowid
+
+    def get_events(self, job_id: str, after: int = 0, limit: int = 500) -> List[Dict]:
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT id, type, data, created_at FROM events"
+                " WHERE job_id = ? AND id > ? ORDER BY id LIMIT ?",
+                (job_id, after, limit),
+            ).fetchall()
+        return [
+            {
+                "id": row["id"],
+                "type": row["type"],
+                "data": json.loads(row["data"]),
+                "created_at": row["created_at"],
+            }
+            for row in rows
+        ]
+
+    def get_status(self, job_id: str) -> Optional[str]:
+        # Cheap status check that skips loading trees and results
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT status, updated_at FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None or self.is_expired(row):
+            return None
+        return row["status"]
+
+    def get_job(self, job_id: str) -> Optional[Dict]:
+        with self.connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or self.is_expired(row):
+                return None
+            trees = conn.execute(
+                "SELECT scenario_index, scenario, nodes FROM trees"
+                " WHERE job_id = ? ORDER BY scenario_index",
+                (job_id,),
+            ).fetchall()
+        job = self.row_to_job(row)
+        job["trees"] = [
+            {
+                "scenario_index": tree["scenario_index"],
+                "scenario": tree["scenario"],
+                "nodes": json.loads(tree["nodes"]),
+            }
+            for tree in trees
+        ]
+        return job
+
+    def latest_job_id(self, kind: str, system_prompt: str) -> Optional[str]:
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE kind = ? AND system_prompt = ?"
+                " AND (status NOT IN (?, ?) OR updated_at >= ?)"
+                " ORDER BY created_at DESC LIMIT 1",
+                (kind, system_prompt, *FINAL_STATUSES, time.time() - self.ttl_seconds),
+            ).fetchone()
+        return row["id"] if row else None
+
+    def evict(self) -> None:
+        # Only finished jobs are evicted; unfinished ones are failed by
+        # fail_stale() once their worker is gone and expire after that
+        with self.connect() as conn:
+            evicted = conn.execute(
+                "DELETE FROM jobs WHERE updated_at < ? AND status IN (?, ?) RETURNING id",
+                (time.time() - self.ttl_seconds, *FINAL_STATUSES),
+            ).fetchall()
+            [unfinished] = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status NOT IN (?, ?)", FINAL_STATUSES
+            ).fetchone()
+            evicted += conn.execute(
+                "DELETE FROM jobs WHERE id IN ("
+                " SELECT id FROM jobs WHERE status IN (?, ?)"
+                " ORDER BY created_at DESC LIMIT -1 OFFSET ?) RETURNING id",
+                (*FINAL_STATUSES, max(0, self.max_jobs - unfinished)),
+            ).fetchall()
+        job_ids = [row["id"] for row in evicted]
+        if job_ids:
+            for listener in self.evict_listeners:
+                listener(job_ids)
+
+    def is_expired(self, row: sqlite3.Row) -> bool:
+        # A long search may go past the TTL without a status update; only
+        # finished jobs expire (stale unfinished ones are failed first)
+        if row["status"] not in FINAL_STATUSES:
+            return False
+        return row["updated_at"] < time.time() - self.ttl_seconds
+
+    def row_to_job(self, row: sqlite3.Row) -> Dict:
+        job = dict(row)
+        for name in JSON_FIELDS:
+            if job[name] is not None:
+                job[name] = json.loads(job[name])
+        return job
+
+
+class EventWriter:
+    """Writes job events and trees from a background thread, in batches.
+
+    add_event() and add_tree() only queue the write, so search code on the
+    event loop or a worker thread never waits for SQLite. Whatever has
+    queued up since the last write goes out in one transaction. Call
+    flush() before a job's final status update so clients see every event
+    before the stream ends; it waits only for what was queued before the
+    call, not for events other jobs keep adding meanwhile.
+    """
+
+    def __init__(self, store: JobStore, max_batch: int = 500):
+        self.store = store
+        self.max_batch = max_batch
+        self.queue: queue.Queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="job-events", daemon=True)
+        self.thread.start()
+
+    def add_event(self, job_id: str, event_type: str, data: Dict) -> None:
+        self.queue.put(("event", job_id, event_type, data))
+
+    def add_tree(self, job_id: str, scenario_index: int, scenario: str, nodes: List[Dict]) -> None:
+        self.queue.put(("tree", job_id, scenario_index, scenario, nodes))
+
+    def flush(self) -> None:
+        # The queue is FIFO, so once the writer reaches this marker every
+        # item queued before it has been written
+        written = threading.Event()
+        self.queue.put(("flush", written))
+        written.wait()
+
+    def run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            markers = [item[1] for item in batch if item[0] == "flush"]
+            try:
+                self.write([item for item in batch if item[0] != "flush"])
+            finally:
+                for written in markers:
+                    written.set()
+
+    def write(self, batch: List[Tuple]) -> None:
+        if not batch:
+            return
+        try:
+            self.store.write_batch(batch)
+            return
+        except sqlite3.Error:
+            pass
+        # One bad item, such as an event of a job evicted meanwhile, must
+        # not lose the rest of the batch
+        for item in batch:
+            try:
+                self.store.write_batch([item])
+            except sqlite3.Error:
+                log.exception("Job store write dropped", job_id=item[1], kind=item[0])
+
+
+job_store = JobStore(
+    os.environ.get("JOB_STORE_PATH", "jobs.sqlite3"),
+    ttl_seconds=float(os.environ.get("JOB_TTL_SECONDS", 24 * 60 * 60)),
+    max_jobs=int(os.environ.get("JOB_STORE_MAX_JOBS", "1000")),
+    lease_seconds=float(os.environ.get("JOB_LEASE_SECONDS", "30")),
+)
+event_writer = EventWriter(job_store)
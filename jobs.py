@@ -0,0 +1,159 @@
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Set
+
+from structured_log import get_logger
+
+log = get_logger("jobs")
+
+
+class JobRejected(Exception):
+    """Raised by JobRunner.admit when the service is saturated."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class JobRunner:
+    """Runs long security tests off the FastAPI request path.
+
+    At most ``max_workers`` jobs run at once, coroutines as tasks on the
+    running event loop and plain (blocking) callables on a thread pool of
+    the same size. Admitted jobs wait in a FIFO queue of at most
+    ``max_queued`` entries, and each client may have ``max_per_client``
+    jobs queued or running. Past either limit, admit() raises JobRejected
+    with a retry hint instead of taking on more work.
+
+    All bookkeeping happens on the event loop thread, so no locks are needed.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 4,
+        max_queued: int = 16,
+        max_per_client: int = 2,
+        default_job_seconds: float = 60.0,
+    ):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.max_per_client = max_per_client
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="security-test"
+        )
+        self.slots = asyncio.Semaphore(max_workers)
+        # job_id -> client, in admission order
+        self.waiting: "OrderedDict[str, str]" = OrderedDict()
+        self.running: Dict[str, str] = {}
+        # Strong references so running tasks are not garbage collected
+        self.tasks: Set[asyncio.Task] = set()
+        # Moving average of job run time, used for wait estimates
+        self.avg_job_seconds = default_job_seconds
+        self.completed = 0
+        self.rejected = 0
+
+    def admit(self, job_id: str, client: str) -> None:
+        """Reserve a queue place for a job that will be submitted shortly."""
+        if len(self.waiting) >= self.max_queued:
+            self.rejected += 1
+            raise JobRejected("Job queue is full.", self.retry_after())
+        active = sum(1 for c in self.waiting.values() if c == client) + sum(
+            1 for c in self.running.values() if c == client
+        )
+        if active >= self.max_per_client:
+            self.rejected += 1
+            raise JobRejected(
+                f"Client already has {active} active jobs (limit {self.max_per_client}).",
+                self.retry_after(),
+            )
+        self.waiting[job_id] = client
+
+    def release(self, job_id: str) -> None:
+        # Give back the place of an admitted job that will not be submitted
+        self.waiting.pop(job_id, None)
+
+    def submit(self, job_id: str, job: Callable[..., Any], *args: Any) -> asyncio.Task:
+        task = asyncio.create_task(self._run(job_id, job, *args))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def run_blocking(self, job: Callable[..., Any], *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, job, *args)
+
+    async def _run(self, job_id: str, job: Callable[..., Any], *args: Any) -> Any:
+        try:
+            async with self.slots:
+                self.running[job_id] = self.waiting.pop(job_id, "")
+                started = time.monotonic()
+                try:
+                    if asyncio.iscoroutinefunction(job):
+                        return await job(*args)
+                    return await self.run_blocking(job, *args)
+                finally:
+                    del self.running[job_id]
+                    self.record_duration(time.monotonic() - started)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Job failed", job_id=job_id)
+        finally:
+            self.waiting.pop(job_id, None)
+
+    def record_duration(self, seconds: float) -> None:
+        self.completed += 1
+        self.avg_job_seconds += 0.2 * (seconds - self.avg_job_seconds)
+
+    def position(self, job_id: str) -> Optional[int]:
+        # 0-based place in the queue, or None if the job is not waiting here
+        for position, waiting_id in enumerate(self.waiting):
+            if waiting_id == job_id:
+                return position
+        return None
+
+    def estimated_wait(self, position: int) -> float:
+        free = self.max_workers - len(self.running)
+        if position < free:
+            return 0.0
+        return math.ceil((position - free + 1) / self.max_workers) * self.avg_job_seconds
+
+    def retry_after(self) -> int:
+        # Roughly when the next running job should finish and free a slot
+        return max(1, math.ceil(self.avg_job_seconds / self.max_workers))
+
+    @property
+    def active_jobs(self) -> int:
+        return len(self.tasks)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": len(self.running),
+            "queued": len(self.waiting),
+            "max_workers": self.max_workers,
+            "max_queued": self.max_queued,
+            "max_per_client": self.max_per_client,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_job_seconds": self.avg_job_seconds,
+            # Wait for a job admitted now
+            "estimated_wait_seconds": self.estimated_wait(len(self.waiting)),
+        }
+
+    def shutdown(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+job_runner = JobRunner(
+    max_workers=int(os.environ.get("JOB_WORKERS", "4")),
+    max_queued=int(os.environ.get("JOB_QUEUE_SIZE", "16")),
+    max_per_client=int(os.environ.get("JOB_MAX_PER_CLIENT", "2")),
+    default_job_seconds=float(os.environ.get("JOB_ESTIMATE_SECONDS", "60")),
+)
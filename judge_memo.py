@@ -0,0 +1,201 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from metrics import tally
+
+JudgeKey = Tuple[str, str, str]
+
+
+class JudgeMemo:
+    """Process-wide memo of judge verdicts.
+
+    Requests are keyed on (attack_scenario, system_prompt, model_response),
+    the only inputs the judge template sees. A finished verdict is served
+    from memory, and a request whose twin is still in flight waits for that
+    call instead of sending its own. Verdicts from earlier processes come
+    from the LLM response cache underneath the judge chain.
+
+    Waiters can belong to other jobs, so only an ordinary Exception from
+    the leader is passed on to them. A leader that is cancelled or
+    interrupted hands the key back and the next waiter retries as leader.
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self.verdicts: "OrderedDict[JudgeKey, str]" = OrderedDict()
+        self.in_flight: Dict[JudgeKey, Future] = {}
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "memo_hits": 0, "in_flight_joins": 0, "judge_calls": 0}
+
+    @staticmethod
+    def make_key(input: Dict[str, Any]) -> JudgeKey:
+        return (
+            str(input["attack_scenario"]),
+            str(input["system_prompt"]),
+            str(input["model_response"]),
+        )
+
+    def lookup(
+        self, key: JudgeKey, retry: bool = False
+    ) -> Tuple[Optional[str], Optional[Future], bool]:
+        # Returns (verdict, future, is_leader); the leader must resolve the
+        # future. A waiter whose leader went away looks up again with retry;
+        # it was counted as a join, which only changes if it now leads
+        with self.lock:
+            if not retry:
+                self.counters["requests"] += 1
+            if key in self.verdicts:
+                self.verdicts.move_to_end(key)
+                self.counters["memo_hits"] += 1
+                if retry:
+                    self.counters["in_flight_joins"] -= 1
+                return self.verdicts[key], None, False
+            future = self.in_flight.get(key)
+            if future is not None:
+                if not retry:
+                    self.counters["in_flight_joins"] += 1
+                return None, future, False
+            future = Future()
+            self.in_flight[key] = future
+            self.counters["judge_calls"] += 1
+            if retry:
+                self.counters["in_flight_joins"] -= 1
+            return None, future, True
+
+    def finish(self, key: JudgeKey, future: Future, verdict: Optional[str], error: Optional[BaseException]):
+        with self.lock:
+            self.in_flight.pop(key, None)
+            if error is None:
+                self.verdicts[key] = verdict
+                self.verdicts.move_to_end(key)
+                while len(self.verdicts) > self.max_entries:
+                    self.verdicts.popitem(last=False)
+        if error is None:
+            future.set_result(verdict)
+        else:
+            future.set_exception(error)
+
+    def abandon(self, key: JudgeKey, future: Future) -> None:
+        # The leader was cancelled; a None result sends waiters back to lookup()
+        with self.lock:
+            self.in_flight.pop(key, None)
+        future.set_result(None)
+
+    def call(self, input: Dict[str, Any], compute: Callable[[], str]) -> str:
+        key = self.make_key(input)
+        retry = False
+        while True:
+            verdict, future, is_leader = self.lookup(key, retry)
+            if verdict is not None:
+                return verdict
+            if not is_leader:
+                verdict = future.result()
+                if verdict is None:
+                    retry = True
+                    continue
+                return verdict
+            try:
+                verdict = compute()
+            except Exception as e:
+                self.finish(key, future, None, e)
+                raise
+            except BaseException:
+                self.abandon(key, future)
+                raise
+            self.finish(key, future, verdict, None)
+            return verdict
+
+    async def acall(self, input: Dict[str, Any], compute: Callable[[], Awaitable[str]]) -> str:
+        key = self.make_key(input)
+        retry = False
+        while True:
+            verdict, future, is_leader = self.lookup(key, retry)
+            if verdict is not None:
+                return verdict
+            if not is_leader:
+                # Shielded: a cancelled waiter must not cancel the shared future
+                verdict = await asyncio.shield(asyncio.wrap_future(future))
+                if verdict is None:
+                    retry = True
+                    continue
+                return verdict
+            try:
+                verdict = await compute()
+            except Exception as e:
+                self.finish(key, future, None, e)
+                raise
+            except BaseException:
+                self.abandon(key, future)
+                raise
+            self.finish(key, future, verdict, None)
+            return verdict
+
+    def clear(self) -> None:
+        # Forget finished verdicts; in-flight calls are left alone
+        with self.lock:
+            self.verdicts.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            stats = dict(self.counters)
+        stats["judge_calls_removed"] = stats["memo_hits"] + stats["in_flight_joins"]
+        return stats
+
+
+class MemoizedJudge(Runnable):
+    """Routes a judge chain through a JudgeMemo and counts this chain's share.
+
+    Counts also go to the current run's tallies under `name`.
+    """
+
+    def __init__(self, judge_chain: Runnable, memo: JudgeMemo, name: str = "judge"):
+        self.judge_chain = judge_chain
+        self.memo = memo
+        self.name = name
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "judge_calls": 0}
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            self.counters[name] += 1
+        tally(self.name, name)
+
+    def invoke(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> AIMessage:
+        self.count("requests")
+
+        def compute() -> str:
+            self.count("judge_calls")
+            return self.judge_chain.invoke(input, config, **kwargs).content
+
+        return AIMessage(content=self.memo.call(input, compute))
+
+    async def ainvoke(
+        self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AIMessage:
+        self.count("requests")
+
+        async def compute() -> str:
+            self.count("judge_calls")
+            return (await self.judge_chain.ainvoke(input, config, **kwargs)).content
+
+        return AIMessage(content=await self.memo.acall(input, compute))
+
+    @staticmethod
+    def summarize(counters: Dict[str, float]) -> Dict[str, int]:
+        stats = {name: int(counters.get(name, 0)) for name in ("requests", "judge_calls")}
+        stats["judge_calls_removed"] = stats["requests"] - stats["judge_calls"]
+        return stats
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            counters = dict(self.counters)
+        return self.summarize(counters)
+
+
+judge_memo = JudgeMemo()
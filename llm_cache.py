@@ -0,0 +1,302 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Tuple
+
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.runnables import Runnable, RunnableConfig
+
+
+class LLMCache:
+    """Content-addressed cache for LLM completions.
+
+    A small in-memory LRU sits in front of a persistent disk tier where each
+    completion is stored as ``<directory>/<key[:2]>/<key>.json``. Keys are a
+    SHA-256 over the model name, prompt template and input variables, so the
+    same request always maps to the same entry across processes and restarts.
+
+    Entries older than ``ttl_seconds`` are misses in both tiers; a memory
+    entry is as old as the file it came from. The disk tier is bounded: a
+    background sweep deletes expired entries and, once the directory
+    grows past ``max_disk_bytes``, the oldest ones until it is back under.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_memory_entries: int = 1024,
+        enabled: bool = True,
+        max_disk_bytes: Optional[int] = None,
+        ttl_seconds: Optional[float] = None,
+    ):
+        self.directory = directory
+        self.max_memory_entries = max_memory_entries
+        self.enabled = enabled
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_seconds = ttl_seconds
+        # key -> (content, time written)
+        self.memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "writes": 0,
+            "disk_evictions": 0,
+        }
+        # Estimated size of the disk tier; None until the first sweep scans it
+        self.disk_bytes: Optional[int] = None
+        self.last_sweep = 0.0
+        self.sweeping = False
+
+    @staticmethod
+    def make_key(model: str, template: str, variables: Any) -> str:
+        payload = json.dumps(
+            {"model": model, "template": template, "variables": variables},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        content = self.get_memory(key)
+        return content if content is not None else self.get_disk(key)
+
+    async def aget(self, key: str) -> Optional[str]:
+        # The disk tier is read on a thread, off the event loop
+        if not self.enabled:
+            return None
+        content = self.get_memory(key)
+        if content is not None:
+            return content
+        return await asyncio.to_thread(self.get_disk, key)
+
+    def get_memory(self, key: str) -> Optional[str]:
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is None:
+                return None
+            content, written = entry
+            if self.expired(written, time.time()):
+                del self.memory[key]
+                return None
+            self.memory.move_to_end(key)
+            self.counters["memory_hits"] += 1
+            return content
+
+    def get_disk(self, key: str) -> Optional[str]:
+        try:
+            with open(self.path_for(key), encoding="utf-8") as f:
+                written = os.fstat(f.fileno()).st_mtime
+                if self.expired(written, time.time()):
+                    raise KeyError(key)
+                content = json.load(f)["content"]
+        except (OSError, ValueError, KeyError):
+            with self.lock:
+                self.counters["misses"] += 1
+            return None
+
+        with self.lock:
+            self.counters["disk_hits"] += 1
+            self.remember(key, content, written)
+        return content
+
+    async def aset(self, key: str, content: str) -> None:
+        if self.enabled:
+            await asyncio.to_thread(self.set, key, content)
+
+    def set(self, key: str, content: str) -> None:
+        if not self.enabled:
+            return
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a private temp file first so readers never see partial entries
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"content": content}, f)
+            size = f.tell()
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.counters["writes"] += 1
+            self.remember(key, content, time.time())
+            if self.disk_bytes is not None:
+                # Overwrites are counted twice; the next sweep corrects that
+                self.disk_bytes += size
+            sweep = self.sweep_due(time.time())
+            if sweep:
+                self.sweeping = True
+        if sweep:
+            threading.Thread(target=self.sweep, name="llm-cache-sweep", daemon=True).start()
+
+    def remember(self, key: str, content: str, written: float) -> None:
+        # Caller must hold self.lock
+        self.memory[key] = (content, written)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def expired(self, mtime: float, now: float) -> bool:
+        return self.ttl_seconds is not None and mtime < now - self.ttl_seconds
+
+    def sweep_due(self, now: float) -> bool:
+        # Caller must hold self.lock
+        if self.sweeping or (self.max_disk_bytes is None and self.ttl_seconds is None):
+            return False
+        if self.disk_bytes is None:
+            return True
+        if self.max_disk_bytes is not None and self.disk_bytes > self.max_disk_bytes:
+            return True
+        return self.ttl_seconds is not None and now - self.last_sweep > self.ttl_seconds
+
+    def sweep(self) -> None:
+        """Deletes expired entries, then the oldest ones while over budget.
+
+        Stops at 90% of max_disk_bytes so a full cache isn't swept on every
+        write. Other processes may share the directory, so entries that
+        vanish mid-sweep are skipped.
+        """
+        now = time.time()
+        with self.lock:
+            written_before = self.disk_bytes or 0
+        entries = []
+        total = removed = 0
+        try:
+            for dirpath, _, filenames in os.walk(self.directory):
+                for filename in filenames:
+                    if not filename.endswith(".json"):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+            target = None if self.max_disk_bytes is None else int(self.max_disk_bytes * 0.9)
+            for mtime, size, path in entries:
+                if not self.expired(mtime, now) and (target is None or total <= target):
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+        finally:
+            with self.lock:
+                self.counters["disk_evictions"] += removed
+                # Keep what set() added while the directory was being walked
+                self.disk_bytes = total + (self.disk_bytes or 0) - written_before
+                self.last_sweep = now
+                self.sweeping = False
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            stats = dict(self.counters)
+            stats["memory_entries"] = len(self.memory)
+            stats["disk_bytes"] = self.disk_bytes
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (
+            (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        )
+        stats["enabled"] = self.enabled
+        return stats
+
+
+class CachedRunnable(Runnable):
+    """Wraps a chain or chat model so completions are served from an LLMCache.
+
+    ``template`` names the prompt template the wrapped runnable renders; it is
+    empty for raw model calls where the input itself is the whole prompt.
+    """
+
+    def __init__(self, runnable: Runnable, cache: LLMCache, model: str, template: str = ""):
+        self.runnable = runnable
+        self.cache = cache
+        self.model = model
+        self.template = template
+
+    def cache_key(self, input: Any) -> str:
+        return self.cache.make_key(self.model, self.template, input)
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> AIMessage:
+        key = self.cache_key(input)
+        content = self.cache.get(key)
+        if content is not None:
+            return AIMessage(content=content)
+
+        response = self.runnable.invoke(input, config, **kwargs)
+        self.cache.set(key, response.content)
+        return response
+
+    async def ainvoke(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AIMessage:
+        key = self.cache_key(input)
+        content = await self.cache.aget(key)
+        if content is not None:
+            return AIMessage(content=content)
+
+        response = await self.runnable.ainvoke(input, config, **kwargs)
+        await self.cache.aset(key, response.content)
+        return response
+
+    def stream(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> Iterator[AIMessageChunk]:
+        key = self.cache_key(input)
+        content = self.cache.get(key)
+        if content is not None:
+            yield AIMessageChunk(content=content)
+            return
+
+        parts = []
+        for chunk in self.runnable.stream(input, config, **kwargs):
+            parts.append(chunk.content)
+            yield chunk
+        # Only complete streams are cached
+        self.cache.set(key, "".join(parts))
+
+    async def astream(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AsyncIterator[AIMessageChunk]:
+        key = self.cache_key(input)
+        content = await self.cache.aget(key)
+        if content is not None:
+            yield AIMessageChunk(content=content)
+            return
+
+        parts = []
+        async for chunk in self.runnable.astream(input, config, **kwargs):
+            parts.append(chunk.content)
+            yield chunk
+        await self.cache.aset(key, "".join(parts))
+
+
+def model_name(llm: Any) -> str:
+    return getattr(llm, "model", None) or type(llm).__name__
+
+
+def llm_cache_from_env() -> LLMCache:
+    ttl_seconds = os.environ.get("LLM_CACHE_TTL_SECONDS")
+    return LLMCache(
+        os.environ.get("LLM_CACHE_DIR", ".llm_cache"),
+        max_memory_entries=int(os.environ.get("LLM_CACHE_MEMORY_ENTRIES", "1024")),
+        enabled=os.environ.get("LLM_CACHE_DISABLED", "") not in ("1", "true", "yes"),
+        max_disk_bytes=int(float(os.environ.get("LLM_CACHE_MAX_DISK_MB", "1024")) * 2**20),
+        ttl_seconds=float(ttl_seconds) if ttl_seconds else None,
+    )
+
+
+llm_cache = llm_cache_from_env()
@@ -0,0 +1,843 @@
+import asyncio
+import contextvars
+import math
+import os
+import random
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterator, List, Optional
+
+import httpx
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_mistralai import ChatMistralAI
+
+from branch_history import estimate_tokens
+from cassette import CassetteModel, llm_cassette
+from llm_cache import model_name
+from metrics import record_llm_call
+from tracing import add_span, span
+
+# Status codes worth retrying; 429 also shrinks the concurrency limit
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Call roles with their own deadlines and hedging; see RolePolicy
+ROLES = ("generator", "target", "judge")
+DEFAULT_ROLE = "default"
+
+
+class LLMTimeout(TimeoutError):
+    """An LLM call ran past its role's deadline."""
+
+
+def timed_out(result: Any) -> bool:
+    """Checks one result of batch(..., return_exceptions=True).
+
+    True when the call was still timing out after the gateway's last
+    retry; the search drops that node instead of failing. Any other
+    error is raised.
+    """
+    if isinstance(result, LLMTimeout):
+        return True
+    if isinstance(result, BaseException):
+        raise result
+    return False
+
+
+class AbandonedCall(LLMTimeout):
+    """A sync call that timed out and is still running on its thread."""
+
+
+class TokenBucket:
+    """Allows `rate_per_minute` units per minute, with up to one minute of burst.
+
+    A rate of None disables the bucket. The level may go negative when a
+    request turns out to cost more than was reserved, which delays later
+    requests until the debt is paid back.
+    """
+
+    def __init__(self, rate_per_minute: Optional[float]):
+        self.rate = rate_per_minute / 60 if rate_per_minute else None
+        self.capacity = rate_per_minute or 0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_take(self, amount: float) -> float:
+        # Returns 0 when taken, otherwise the seconds until it would be
+        if self.rate is None:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+            amount = min(amount, self.capacity)
+            if self.level >= amount:
+                self.level -= amount
+                return 0.0
+            return (amount - self.level) / self.rate
+
+    def give_back(self, amount: float) -> None:
+        if self.rate is None:
+            return
+        with self.lock:
+            self.level = min(self.capacity, self.level + amount)
+
+
+class SlotWaiter:
+    """A thread or a task queued for a concurrency slot."""
+
+    __slots__ = ("event", "future", "loop", "granted")
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.loop = loop
+        self.event = threading.Event() if loop is None else None
+        self.future = loop.create_future() if loop is not None else None
+        # Set under the limiter's lock when a slot is handed over
+        self.granted = False
+
+    def wake(self) -> bool:
+        # False when the waiter's loop is already closed
+        if self.loop is None:
+            self.event.set()
+            return True
+        try:
+            self.loop.call_soon_threadsafe(self.resolve)
+        except RuntimeError:
+            return False
+        return True
+
+    def resolve(self) -> None:
+        # Runs on the waiter's loop; a cancelled waiter gives its slot back
+        # itself in aacquire()
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class AdaptiveConcurrency:
+    """AIMD limit on in-flight requests.
+
+    Every success without a latency problem adds 1/limit (about +1 per
+    round of requests). A 429 halves the limit, and a response slower than
+    `target_latency` takes 10% off. Decreases happen at most once per
+    `cooldown` seconds so one burst of 429s is not counted several times.
+
+    Callers over the limit wait in one FIFO queue, threads and tasks alike,
+    and release() hands freed slots to them in order, so nobody polls and
+    nobody starves.
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        minimum: int,
+        maximum: int,
+        target_latency: Optional[float] = None,
+        cooldown: float = 1.0,
+    ):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.waiters: Deque[SlotWaiter] = deque()
+        self.lock = threading.Lock()
+
+    def enqueue(self, loop: Optional[asyncio.AbstractEventLoop]) -> Optional[SlotWaiter]:
+        # Takes a free slot, or returns the queued waiter to block on
+        with self.lock:
+            if not self.waiters and self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return None
+            waiter = SlotWaiter(loop)
+            self.waiters.append(waiter)
+            return waiter
+
+    def acquire(self) -> None:
+        waiter = self.enqueue(None)
+        if waiter is not None:
+            waiter.event.wait()
+
+    async def aacquire(self) -> None:
+        waiter = self.enqueue(asyncio.get_running_loop())
+        if waiter is None:
+            return
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self.lock:
+                granted = waiter.granted
+                if not granted:
+                    self.waiters.remove(waiter)
+            if granted:
+                self.release(None, False)
+            raise
+
+    def hand_over(self) -> None:
+        # Caller must hold self.lock
+        while self.waiters and self.in_flight < int(self.limit):
+            waiter = self.waiters.popleft()
+            if waiter.wake():
+                waiter.granted = True
+                self.in_flight += 1
+
+    def release(self, latency: Optional[float], throttled: bool) -> None:
+        with self.lock:
+            self.in_flight -= 1
+            now = time.monotonic()
+            slow = (
+                latency is not None
+                and self.target_latency is not None
+                and latency > self.target_latency
+            )
+            if throttled or slow:
+                if now - self.last_decrease >= self.cooldown:
+                    factor = 0.5 if throttled else 0.9
+                    self.limit = max(self.minimum, self.limit * factor)
+                    self.last_decrease = now
+            elif latency is not None:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.hand_over()
+
+
+class Permit:
+    """One admitted attempt; release() must run exactly once."""
+
+    def __init__(self, gateway: "LLMGateway", tokens: int, policy: "RolePolicy"):
+        self.gateway = gateway
+        self.tokens = tokens
+        self.policy = policy
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(
+        self, throttled: bool = False, output: Optional[str] = None, usage: Optional[int] = None
+    ) -> None:
+        if self.released:
+            return
+        self.released = True
+        latency = time.monotonic() - self.started if output is not None else None
+        self.gateway.concurrency.release(latency, throttled)
+        if output is not None:
+            self.policy.record_latency(latency)
+            # Settle the token reservation against what the call really cost
+            if not usage:
+                usage = self.tokens - self.gateway.expected_output_tokens + estimate_tokens(output)
+            self.gateway.tokens.give_back(self.tokens - usage)
+
+
+class LLMGateway(Runnable):
+    """Process-wide entry point for chat model calls.
+
+    Every chain in attack_tap and defense_tap pipes into this runnable
+    instead of its own client. It shares one pooled HTTP client for sync
+    calls, plus one per event loop for async calls because httpx async
+    pools cannot cross loops. It also applies token buckets on requests
+    and tokens per minute and AIMD adaptive concurrency. Failed calls
+    (429, 5xx, transport errors, timeouts) are retried with full-jitter
+    exponential backoff that honours Retry-After. The wrapped client's own
+    retries are turned off, so this is the only retry policy.
+
+    Chains use role(name) to get per-role deadlines and hedging (see
+    RolePolicy); calling the gateway directly uses the "default" role.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], Runnable],
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        initial_concurrency: int = 8,
+        min_concurrency: int = 1,
+        max_concurrency: int = 32,
+        target_latency: Optional[float] = None,
+        max_retries: int = 5,
+        base_backoff: float = 1.0,
+        max_backoff: float = 30.0,
+        expected_output_tokens: int = 512,
+        policies: Optional[List["RolePolicy"]] = None,
+    ):
+        self.factory = factory
+        self.sync_model = factory()
+        self.model = model_name(self.sync_model)
+        self.loop_models: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.concurrency = AdaptiveConcurrency(
+            initial_concurrency, min_concurrency, max_concurrency, target_latency
+        )
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        # Output tokens reserved per request until the real count is known
+        self.expected_output_tokens = expected_output_tokens
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "retries": 0, "throttled": 0, "rate_limited_waits": 0}
+        self.policies: Dict[str, RolePolicy] = {p.name: p for p in policies or ()}
+        # Threads for sync hedging and for sync calls with a deadline
+        self.hedge_executor = ThreadPoolExecutor(
+            max_workers=2 * max_concurrency, thread_name_prefix="llm-hedge"
+        )
+        self.call_executor = ThreadPoolExecutor(
+            max_workers=2 * max_concurrency, thread_name_prefix="llm-call"
+        )
+
+    def set_factory(self, factory: Callable[[], Runnable]) -> None:
+        # Swap the underlying chat model, e.g. for an offline stand-in
+        with self.lock:
+            self.factory = factory
+            self.sync_model = factory()
+            self.model = model_name(self.sync_model)
+            self.loop_models = weakref.WeakKeyDictionary()
+
+    def async_model(self) -> Runnable:
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            model = self.loop_models.get(loop)
+            if model is None:
+                model = self.factory()
+                self.loop_models[loop] = model
+        return model
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            self.counters[name] += 1
+
+    def estimate_request_tokens(self, input: Any) -> int:
+        text = input.to_string() if hasattr(input, "to_string") else str(input)
+        return estimate_tokens(text) + self.expected_output_tokens
+
+    def reserve(self, tokens: int) -> float:
+        wait = self.requests.try_take(1)
+        if wait:
+            return wait
+        wait = self.tokens.try_take(tokens)
+        if wait:
+            self.requests.give_back(1)
+        return wait
+
+    def acquire(self, tokens: int, policy: "RolePolicy") -> Permit:
+        queued = time.perf_counter()
+        self.concurrency.acquire()
+        permit = Permit(self, tokens, policy)
+        try:
+            while True:
+                wait = self.reserve(tokens)
+                if not wait:
+                    break
+                self.count("rate_limited_waits")
+                time.sleep(wait)
+        except BaseException:
+            permit.release()
+            raise
+        permit.started = time.monotonic()
+        self.count("requests")
+        add_span("queued", queued, "gateway", role=policy.name)
+        return permit
+
+    async def aacquire(self, tokens: int, policy: "RolePolicy") -> Permit:
+        queued = time.perf_counter()
+        await self.concurrency.aacquire()
+        permit = Permit(self, tokens, policy)
+        try:
+            while True:
+                wait = self.reserve(tokens)
+                if not wait:
+                    break
+                self.count("rate_limited_waits")
+                await asyncio.sleep(wait)
+        except BaseException:
+            permit.release()
+            raise
+        permit.started = time.monotonic()
+        self.count("requests")
+        add_span("queued", queued, "gateway", role=policy.name)
+        return permit
+
+    def retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        # None when the error is final, otherwise how long to back off
+        response = getattr(error, "response", None)
+        status = getattr(response, "status_code", None)
+        transport_error = isinstance(
+            error, (httpx.RequestError, httpx.StreamError, TimeoutError)
+        )
+        if status not in RETRY_STATUSES and not transport_error:
+            return None
+        if attempt >= self.max_retries:
+            return None
+        self.count("retries")
+        delay = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+        try:
+            delay = max(delay, float(response.headers.get("retry-after", 0)))
+        except (AttributeError, TypeError, ValueError):
+            pass
+        return delay
+
+    def is_throttle(self, error: Exception) -> bool:
+        throttled = getattr(getattr(error, "response", None), "status_code", None) == 429
+        if throttled:
+            self.count("throttled")
+        return throttled
+
+    def policy(self, role: str) -> "RolePolicy":
+        with self.lock:
+            if role not in self.policies:
+                self.policies[role] = RolePolicy(role)
+            return self.policies[role]
+
+    def role(self, name: str, stage: Optional[str] = None) -> "GatewayRole":
+        return GatewayRole(self, name, stage)
+
+    def timed(self, policy: "RolePolicy", permit: Permit, call: Callable[[], Any]) -> Any:
+        """Runs a sync call under the role's deadline.
+
+        A blocking HTTP call cannot be interrupted; on timeout its thread
+        runs on until the client's own timeout and the result is dropped.
+        The request is still in flight, so it keeps `permit` until then.
+        """
+        if policy.timeout is None:
+            return call()
+        # The abandoned call's metrics and spans still belong to this run
+        future = self.call_executor.submit(contextvars.copy_context().run, call)
+        try:
+            return future.result(timeout=policy.timeout)
+        except TimeoutError:
+            policy.count("timeouts", "abandoned")
+            future.add_done_callback(lambda _: permit.release())
+            raise AbandonedCall(f"{policy.name} call exceeded {policy.timeout}s") from None
+
+    async def atimed(self, policy: "RolePolicy", call: Awaitable[Any]) -> Any:
+        if policy.timeout is None:
+            return await call
+        try:
+            return await asyncio.wait_for(call, policy.timeout)
+        except asyncio.TimeoutError:
+            policy.count("timeouts", "cancelled")
+            raise LLMTimeout(f"{policy.name} call exceeded {policy.timeout}s") from None
+
+    def attempt(self, policy: "RolePolicy", input: Any, config: Any, kwargs: Dict) -> AIMessage:
+        # One logical request: retries with backoff until success or a final error
+        tokens = self.estimate_request_tokens(input)
+        attempt = 0
+        while True:
+            permit = self.acquire(tokens, policy)
+            try:
+                response = self.timed(
+                    policy, permit, lambda: self.sync_model.invoke(input, config, **kwargs)
+                )
+            except Exception as e:
+                # An abandoned call releases its permit when it really ends
+                if not isinstance(e, AbandonedCall):
+                    permit.release(throttled=self.is_throttle(e))
+                delay = self.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                permit.release()
+                raise
+            permit.release(output=response.content, usage=usage_tokens(response))
+            return response
+
+    async def aattempt(
+        self, policy: "RolePolicy", input: Any, config: Any, kwargs: Dict
+    ) -> AIMessage:
+        tokens = self.estimate_request_tokens(input)
+        attempt = 0
+        while True:
+            permit = await self.aacquire(tokens, policy)
+            try:
+                response = await self.atimed(
+                    policy, self.async_model().ainvoke(input, config, **kwargs)
+                )
+            except Exception as e:
+                permit.release(throttled=self.is_throttle(e))
+                delay = self.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                permit.release()
+                raise
+            permit.release(output=response.content, usage=usage_tokens(response))
+            return response
+
+    def call(self, role: str, input: Any, config: Any, kwargs: Dict) -> AIMessage:
+        """Run a request, hedging it once it is slower than usual for its role.
+
+        The hedge is an independent duplicate request; whichever copy
+        succeeds first wins and the other is abandoned (sync) or cancelled
+        (async).
+        """
+        policy = self.policy(role)
+        policy.count("calls")
+        hedge_after = policy.hedge_delay()
+        if hedge_after is None:
+            return self.attempt(policy, input, config, kwargs)
+
+        # Attempts run on hedge threads, so they get a copy of the caller's context
+        primary = self.hedge_executor.submit(
+            contextvars.copy_context().run, self.attempt, policy, input, config, kwargs
+        )
+        done, _ = wait([primary], timeout=hedge_after)
+        if done:
+            return primary.result()
+        policy.count("hedged")
+        hedge = self.hedge_executor.submit(
+            contextvars.copy_context().run, self.attempt, policy, input, config, kwargs
+        )
+        pending = {primary, hedge}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winners = [future for future in done if future.exception() is None]
+            if winners or not pending:
+                winner = winners[0] if winners else done.pop()
+                if winner is hedge and winners:
+                    policy.count("hedge_wins")
+                for loser in pending:
+                    if not loser.cancel():
+                        policy.count("abandoned")
+                return winner.result()
+
+    async def acall(self, role: str, input: Any, config: Any, kwargs: Dict) -> AIMessage:
+        policy = self.policy(role)
+        policy.count("calls")
+        hedge_after = policy.hedge_delay()
+        if hedge_after is None:
+            return await self.aattempt(policy, input, config, kwargs)
+
+        tasks = [asyncio.ensure_future(self.aattempt(policy, input, config, kwargs))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if done:
+                return tasks[0].result()
+            policy.count("hedged")
+            tasks.append(asyncio.ensure_future(self.aattempt(policy, input, config, kwargs)))
+            pending = set(tasks)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winners = [task for task in done if task.exception() is None]
+                if winners or not pending:
+                    winner = winners[0] if winners else done.pop()
+                    if winner is tasks[1] and winners:
+                        policy.count("hedge_wins")
+                    return winner.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                    policy.count("cancelled")
+
+    def stream_role(
+        self, role: str, input: Any, config: Any, kwargs: Dict
+    ) -> Iterator[AIMessageChunk]:
+        # Streams are never hedged, and sync streams have no deadline
+        policy = self.policy(role)
+        policy.count("calls")
+        tokens = self.estimate_request_tokens(input)
+        attempt = 0
+        while True:
+            permit = self.acquire(tokens, policy)
+            parts = []
+            try:
+                for chunk in self.sync_model.stream(input, config, **kwargs):
+                    parts.append(chunk.content)
+                    yield chunk
+            except Exception as e:
+                permit.release(throttled=self.is_throttle(e))
+                # Output already handed out cannot be taken back
+                delay = None if parts else self.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            finally:
+                permit.release(output="".join(parts))
+            return
+
+    async def astream_role(
+        self, role: str, input: Any, config: Any, kwargs: Dict
+    ) -> AsyncIterator[AIMessageChunk]:
+        # The role timeout bounds the wait for each chunk, not the whole reply
+        policy = self.policy(role)
+        policy.count("calls")
+        tokens = self.estimate_request_tokens(input)
+        attempt = 0
+        while True:
+            permit = await self.aacquire(tokens, policy)
+            parts = []
+            chunks = self.async_model().astream(input, config, **kwargs)
+            try:
+                while True:
+                    try:
+                        chunk = await self.atimed(policy, chunks.__anext__())
+                    except StopAsyncIteration:
+                        break
+                    parts.append(chunk.content)
+                    yield chunk
+            except Exception as e:
+                permit.release(throttled=self.is_throttle(e))
+                delay = None if parts else self.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            finally:
+                permit.release(output="".join(parts))
+                await chunks.aclose()
+            return
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> AIMessage:
+        return self.call(DEFAULT_ROLE, input, config, kwargs)
+
+    async def ainvoke(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AIMessage:
+        return await self.acall(DEFAULT_ROLE, input, config, kwargs)
+
+    def stream(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> Iterator[AIMessageChunk]:
+        return self.stream_role(DEFAULT_ROLE, input, config, kwargs)
+
+    def astream(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AsyncIterator[AIMessageChunk]:
+        return self.astream_role(DEFAULT_ROLE, input, config, kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            stats = dict(self.counters)
+            policies = list(self.policies.values())
+        with self.concurrency.lock:
+            stats["concurrency_limit"] = self.concurrency.limit
+            stats["in_flight"] = self.concurrency.in_flight
+            stats["waiting"] = len(self.concurrency.waiters)
+        stats["roles"] = {policy.name: policy.stats() for policy in policies}
+        return stats
+
+
+class GatewayRole(Runnable):
+    """The gateway as seen by one kind of call (generator, target or judge).
+
+    `stage` names the pipeline step making the calls (consultant, attacker,
+    ...) in the metrics; several stages can share a role's policy. Each
+    logical call is recorded once, with retries and hedges included in its
+    latency.
+    """
+
+    def __init__(self, gateway: LLMGateway, name: str, stage: Optional[str] = None):
+        self.gateway = gateway
+        self.name = name
+        self.stage = stage or name
+        self.model = gateway.model
+
+    def record(self, started: float, input: Any, output: Optional[Any]) -> Dict[str, Any]:
+        # Metrics for one finished call; returns its attributes for the trace
+        usage = getattr(output, "usage_metadata", None) or {}
+        text = input.to_string() if hasattr(input, "to_string") else str(input)
+        attrs = {
+            "input_tokens": usage.get("input_tokens") or estimate_tokens(text),
+            "output_tokens": usage.get("output_tokens")
+            or (estimate_tokens(output.content) if output else 0),
+            "failed": output is None,
+        }
+        record_llm_call(self.stage, time.perf_counter() - started, **attrs)
+        return attrs
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> AIMessage:
+        started, response = time.perf_counter(), None
+        with span(self.stage, "llm", role=self.name) as trace:
+            try:
+                response = self.gateway.call(self.name, input, config, kwargs)
+                return response
+            finally:
+                trace.set(**self.record(started, input, response))
+
+    async def ainvoke(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AIMessage:
+        started, response = time.perf_counter(), None
+        with span(self.stage, "llm", role=self.name) as trace:
+            try:
+                response = await self.gateway.acall(self.name, input, config, kwargs)
+                return response
+            finally:
+                trace.set(**self.record(started, input, response))
+
+    def stream(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> Iterator[AIMessageChunk]:
+        # Traced once finished: a generator can be closed from another task,
+        # so it must not hold a span open across yields
+        started, parts, done = time.perf_counter(), [], False
+        try:
+            for chunk in self.gateway.stream_role(self.name, input, config, kwargs):
+                parts.append(chunk.content)
+                yield chunk
+            done = True
+        finally:
+            attrs = self.record(started, input, AIMessage(content="".join(parts)) if done else None)
+            add_span(self.stage, started, "llm", role=self.name, streamed=True, **attrs)
+
+    async def astream(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AsyncIterator[AIMessageChunk]:
+        started, parts, done = time.perf_counter(), [], False
+        try:
+            async for chunk in self.gateway.astream_role(self.name, input, config, kwargs):
+                parts.append(chunk.content)
+                yield chunk
+            done = True
+        finally:
+            attrs = self.record(started, input, AIMessage(content="".join(parts)) if done else None)
+            add_span(self.stage, started, "llm", role=self.name, streamed=True, **attrs)
+
+
+class RolePolicy:
+    """Deadline and hedging settings, plus latency history, for one role.
+
+    timeout bounds each attempt (each chunk for streams); a timed-out
+    attempt is retried like a transport error. With hedge_percentile set,
+    a call still running after that percentile of recent latencies gets one
+    duplicate request, as long as hedges stay under max_hedge_ratio of calls.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        timeout: Optional[float] = None,
+        hedge_percentile: Optional[float] = None,
+        max_hedge_ratio: float = 0.1,
+        min_samples: int = 20,
+        window: int = 256,
+    ):
+        self.name = name
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.max_hedge_ratio = max_hedge_ratio
+        self.min_samples = min_samples
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.counters = {
+            "calls": 0,
+            "timeouts": 0,
+            "hedged": 0,
+            "hedge_wins": 0,
+            "cancelled": 0,
+            "abandoned": 0,
+        }
+
+    def count(self, *names: str) -> None:
+        with self.lock:
+            for name in names:
+                self.counters[name] += 1
+
+    def record_latency(self, seconds: float) -> None:
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def hedge_delay(self) -> Optional[float]:
+        if self.hedge_percentile is None:
+            return None
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            if self.counters["hedged"] >= self.max_hedge_ratio * self.counters["calls"]:
+                return None
+            return percentile(self.latencies, self.hedge_percentile)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            stats = dict(self.counters)
+            latencies = list(self.latencies)
+        stats.update(latency_summary(latencies))
+        stats["timeout"] = self.timeout
+        stats["hedge_percentile"] = self.hedge_percentile
+        # Extra requests sent as hedges, relative to logical calls
+        stats["duplicate_spend_ratio"] = (
+            stats["hedged"] / stats["calls"] if stats["calls"] else 0.0
+        )
+        return stats
+
+
+def percentile(samples, q: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def latency_summary(samples: List[float]) -> Dict[str, Optional[float]]:
+    if not samples:
+        return {"samples": 0, "p50": None, "p95": None, "p99": None}
+    return {
+        "samples": len(samples),
+        "p50": percentile(samples, 50),
+        "p95": percentile(samples, 95),
+        "p99": percentile(samples, 99),
+    }
+
+
+def usage_tokens(response: Any) -> Optional[int]:
+    usage = getattr(response, "usage_metadata", None) or {}
+    return usage.get("total_tokens")
+
+
+def optional_float(name: str) -> Optional[float]:
+    value = os.environ.get(name)
+    return float(value) if value else None
+
+
+def create_mistral_model() -> ChatMistralAI:
+    return ChatMistralAI(
+        model="mistral-large-latest",
+        api_key=os.environ["MISTRAL_API_KEY"],
+        # Retries are handled by the gateway
+        max_retries=0,
+    )
+
+
+def create_chat_model() -> Runnable:
+    # With LLM_CASSETTE set, traffic is recorded to or replayed from a file
+    if llm_cassette is None:
+        return create_mistral_model()
+    if llm_cassette.mode == "record":
+        return CassetteModel(llm_cassette, create_mistral_model())
+    # Replay runs offline unless misses may go to the live API
+    fallback = None
+    if os.environ.get("LLM_CASSETTE_FALLBACK", "") in ("1", "true", "yes"):
+        fallback = create_mistral_model()
+    return CassetteModel(llm_cassette, fallback=fallback)
+
+
+def role_policy(name: str) -> "RolePolicy":
+    prefix = f"LLM_{name.upper()}_"
+    return RolePolicy(
+        name,
+        timeout=optional_float(prefix + "TIMEOUT"),
+        hedge_percentile=optional_float(prefix + "HEDGE_PERCENTILE"),
+        max_hedge_ratio=float(os.environ.get("LLM_HEDGE_MAX_RATIO", "0.1")),
+    )
+
+
+llm_gateway = LLMGateway(
+    create_chat_model,
+    requests_per_minute=optional_float("LLM_REQUESTS_PER_MINUTE"),
+    tokens_per_minute=optional_float("LLM_TOKENS_PER_MINUTE"),
+    initial_concurrency=int(os.environ.get("LLM_INITIAL_CONCURRENCY", "8")),
+    min_concurrency=int(os.environ.get("LLM_MIN_CONCURRENCY", "1")),
+    max_concurrency=int(os.environ.get("LLM_MAX_CONCURRENCY", "32")),
+    target_latency=optional_float("LLM_TARGET_LATENCY_SECONDS"),
+    max_retries=int(os.environ.get("LLM_MAX_RETRIES", "5")),
+    policies=[role_policy(name) for name in ROLES],
+)
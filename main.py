@@ -1,14 +1,77 @@
 import os
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+import json
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Header, Request
 from pydantic import BaseModel
-from typing import Dict, List, Tuple, Optional
-from fastapi.responses import JSONResponse
+from typing import Callable, Dict, List, Tuple, Optional
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from attack_tap import SecurityTest
-from defense_tap import run_complete_defense_test as def_run_security_test
+from defense_tap import run_complete_defense_test as def_run_security_test, SELECTION_MODES
+from jobs import JobRejected, job_runner
+from job_store import event_writer, job_store, FINAL_STATUSES
+from llm_cache import llm_cache
+from llm_gateway import llm_gateway
+from cassette import llm_cassette
+from judge_memo import judge_memo
+import metrics
+from metrics import RunMetrics, collect_run
+from structured_log import get_logger, log_sink
+from tracing import (
+    Tracer,
+    delete_job_traces,
+    export_job_trace,
+    job_tracer,
+    span,
+    trace_path,
+    tracing,
+)
+from branch_history import HistoryCompactor
+
+log = get_logger("server")
+
+job_store.evict_listeners.append(delete_job_traces)
+
+# How often an idle event stream checks the store, and sends a keep-alive
+EVENT_POLL_SECONDS = float(os.environ.get("JOB_EVENT_POLL_SECONDS", "0.5"))
+EVENT_KEEPALIVE_SECONDS = 15.0
+# How long a coalesced attack request waits for the leader's scenarios
+SCENARIO_WAIT_SECONDS = float(os.environ.get("SCENARIO_WAIT_SECONDS", "300"))
+# Addresses of reverse proxies allowed to name the client in X-Client-Id
+TRUSTED_PROXIES = {
+    host.strip() for host in os.environ.get("TRUSTED_PROXIES", "").split(",") if host.strip()
+}
+
+
+async def keep_jobs_alive():
+    # Renews this process's job leases; also fails jobs left behind by
+    # crashed or restarted workers, which ends their clients' event streams
+    while True:
+        try:
+            await asyncio.to_thread(job_store.heartbeat)
+        except Exception:
+            log.exception("Job heartbeat failed")
+        await asyncio.sleep(job_store.lease_seconds / 3)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    heartbeat = asyncio.create_task(keep_jobs_alive())
+    try:
+        yield
+    finally:
+        heartbeat.cancel()
+        job_runner.shutdown()
+        await asyncio.to_thread(event_writer.flush)
+        if llm_cassette is not None:
+            llm_cassette.close()
+        log_sink.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Use environment variable to adjust CORS for production
 origins = ["*"]  # Allow all domains in development
@@ -28,6 +91,22 @@ class SecurityAttackTestInput(BaseModel):
     max_width: int = 3
     max_depth: int = 3
     top_k: int = 5
+    # Precomputed scenarios to search instead of asking the consultant
+    attack_scenarios: Optional[List[str]] = None
+    # Branch history compaction for the attacker prompt (see branch_history.py)
+    history_strategy: str = "full"
+    history_max_turns: int = 3
+    history_max_response_chars: Optional[int] = None
+    history_max_tokens: Optional[int] = None
+    # Stop conditions (see SecurityTest); 10 is the judge's maximum score
+    success_threshold: Optional[int] = 10
+    prune_below: Optional[int] = None
+    patience: Optional[int] = None
+    # "bfs" or "best_first" (global priority frontier limited by call_budget)
+    search_mode: str = "bfs"
+    call_budget: Optional[int] = None
+    # Evaluate each attack prompt as soon as the attacker has streamed it
+    stream_generation: bool = False
 
 class SecurityDefenseTestInput(BaseModel):
     system_prompt: str
@@ -37,67 +116,394 @@ class SecurityDefenseTestInput(BaseModel):
     max_width: int = 3
     max_depth: int = 3
     top_k: int = 5
+    attack_job_id: Optional[str] = None
+    # Stop conditions (lower is better); 0 means no attack succeeded at all
+    success_threshold: Optional[float] = 0
+    prune_above: Optional[float] = None
+    patience: Optional[int] = None
+    # "full" or "successive_halving" candidate selection (see race_defenses)
+    selection: str = "full"
+    race_eta: int = 2
+    race_initial_per_scenario: int = 1
+
+
+async def resolve_job(kind: str, job_id: Optional[str], system_prompt: Optional[str]) -> Dict:
+    # Older clients identify a test by its system prompt; map that to the latest job
+    if job_id is None and system_prompt is not None:
+        job_id = await asyncio.to_thread(job_store.latest_job_id, kind, system_prompt)
+    job = await asyncio.to_thread(job_store.get_job, job_id) if job_id else None
+    if job is None or job["kind"] != kind:
+        raise HTTPException(status_code=404, detail="Job not found or expired.")
+    return job
+
+
+def client_id(request: Request) -> str:
+    # Quotas are per caller address. X-Client-Id is only believed from a
+    # trusted proxy; from anyone else a fresh value per request would dodge
+    # the quota
+    host = request.client.host if request.client else "unknown"
+    if host in TRUSTED_PROXIES:
+        return request.headers.get("x-client-id") or host
+    return host
+
+
+async def admit_job(job_id: str, request: Request) -> None:
+    try:
+        job_runner.admit(job_id, client_id(request))
+    except JobRejected as e:
+        # Nothing has run yet; drop the job so a retry starts cleanly
+        await asyncio.to_thread(job_store.delete_job, job_id)
+        raise HTTPException(
+            status_code=429,
+            detail={"error": e.reason, "queue": job_runner.stats()},
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+
+def queue_info(job_id: str) -> Dict:
+    # Position is only known to the process that queued the job
+    position = job_runner.position(job_id)
+    return {
+        "position": position,
+        "estimated_wait_seconds": (
+            job_runner.estimated_wait(position) if position is not None else None
+        ),
+        "depth": job_runner.stats()["queued"],
+    }
+
+
+def pending_response(job: Dict) -> JSONResponse:
+    if job["status"] == "failed":
+        return JSONResponse(
+            status_code=500,
+            content={"job_id": job["id"], "status": job["status"], "error": job["error"]},
+        )
+    return JSONResponse(
+        status_code=202,
+        content={
+            "job_id": job["id"],
+            "status": "Still processing",
+            "queue": queue_info(job["id"]),
+            "trees": job["trees"],
+        },
+    )
+
+
+def job_events(job_id: str) -> Callable[[str, Dict], None]:
+    # Queued for the background writer; never blocks the search
+    def record(event_type: str, data: Dict) -> None:
+        event_writer.add_event(job_id, event_type, data)
+
+    return record
+
+
+def sse_event(event: Dict) -> str:
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+
+
+async def event_stream(job_id: str, cursor: int):
+    # Store reads run on worker threads so polling never stalls the event loop
+    last_sent = time.monotonic()
+    while True:
+        events = await asyncio.to_thread(job_store.get_events, job_id, cursor)
+        for event in events:
+            cursor = event["id"]
+            yield sse_event(event)
+        if events:
+            last_sent = time.monotonic()
+            continue
+        # Everything up to the cursor has been sent; stop once the job is over
+        if await asyncio.to_thread(job_store.get_status, job_id) in (None, *FINAL_STATUSES):
+            # The last events may have landed between the read above and
+            # the final status; send them before closing
+            while events := await asyncio.to_thread(job_store.get_events, job_id, cursor):
+                for event in events:
+                    cursor = event["id"]
+                    yield sse_event(event)
+            return
+        if time.monotonic() - last_sent >= EVENT_KEEPALIVE_SECONDS:
+            yield ": keep-alive\n\n"
+            last_sent = time.monotonic()
+        await asyncio.sleep(EVENT_POLL_SECONDS)
+
+
+async def wait_for_scenarios(job_id: str) -> List[str]:
+    # Identical request joined a job whose scenarios may still be generating
+    deadline = time.monotonic() + SCENARIO_WAIT_SECONDS
+    while True:
+        job = await asyncio.to_thread(job_store.get_job, job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found or expired.")
+        if job["status"] == "failed":
+            raise HTTPException(status_code=500, detail=job["error"])
+        if job["scenarios"] is not None:
+            return job["scenarios"]
+        if time.monotonic() >= deadline:
+            raise HTTPException(status_code=504, detail="Timed out waiting for attack scenarios.")
+        await asyncio.sleep(EVENT_POLL_SECONDS)
 
-# Global cache for storing test results and intermediate data
-test_results_cache: Dict[str, Dict[str, any]] = {}
 
 @app.post("/initiate_attack_test/")
-async def initiate_attack_test(input_data: SecurityAttackTestInput, background_tasks: BackgroundTasks):
-    # Create instance of SecurityTest
-    security_test = SecurityTest(
-        input_data.system_prompt,
-        input_data.branching_factor,
-        input_data.max_width,
-        input_data.max_depth,
-        input_data.top_k
+async def initiate_attack_test(input_data: SecurityAttackTestInput, request: Request):
+    try:
+        history_compactor = HistoryCompactor(
+            input_data.history_strategy,
+            input_data.history_max_turns,
+            input_data.history_max_response_chars,
+            input_data.history_max_tokens,
+        )
+        # Create instance of SecurityTest
+        security_test = SecurityTest(
+            input_data.system_prompt,
+            input_data.branching_factor,
+            input_data.max_width,
+            input_data.max_depth,
+            input_data.top_k,
+            attack_scenarios=input_data.attack_scenarios,
+            history_compactor=history_compactor,
+            success_threshold=input_data.success_threshold,
+            prune_below=input_data.prune_below,
+            patience=input_data.patience,
+            search_mode=input_data.search_mode,
+            call_budget=input_data.call_budget,
+            stream_generation=input_data.stream_generation,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Identical requests share one job, its progress stream and its result.
+    # Every store call from a handler runs on a thread: claim_job may wait
+    # on another writer's lock, and jobs share this event loop
+    job_id, created = await asyncio.to_thread(
+        job_store.claim_job, "attack", input_data.system_prompt, input_data.model_dump()
     )
-    # Generate initial attack scenarios quickly and cache
-    scenarios = security_test.generate_attack_scenarios()
+    if not created:
+        scenarios = await wait_for_scenarios(job_id)
+        return JSONResponse(
+            content={
+                "job_id": job_id,
+                "scenarios": scenarios,
+                "coalesced": True,
+                "queue": queue_info(job_id),
+            }
+        )
+    # Admit before the consultant call so a saturated service spends nothing
+    await admit_job(job_id, request)
+    security_test.on_event = job_events(job_id)
+    run_metrics = RunMetrics()
+    # None unless TRACE_DIR is set
+    tracer = job_tracer("attack", job_id)
 
-    test_results_cache[input_data.system_prompt] = {"scenarios": scenarios, "attacks": None, "defenses": None}
+    # Generate initial attack scenarios quickly and store them with the job
+    try:
+        with collect_run(run_metrics), tracing(tracer), span("scenarios", "job"):
+            scenarios = await security_test.agenerate_attack_scenarios()
+    except Exception as e:
+        job_runner.release(job_id)
+        await asyncio.to_thread(job_store.update_job, job_id, status="failed", error=str(e))
+        await asyncio.to_thread(export_job_trace, tracer, job_id)
+        raise
+    await asyncio.to_thread(job_store.update_job, job_id, scenarios=scenarios)
 
-    # Background task to generate detailed attacks
-    background_tasks.add_task(run_detailed_attacks, security_test)
-    return JSONResponse(content={"scenarios": scenarios})
+    # The scenarios are now pinned on security_test, so the background search
+    # fans out over exactly the ones returned here without another consultant call
+    job_runner.submit(
+        job_id, run_detailed_attacks, job_id, security_test, run_metrics, tracer
+    )
+    return JSONResponse(
+        content={
+            "job_id": job_id,
+            "scenarios": scenarios,
+            "coalesced": False,
+            "queue": queue_info(job_id),
+        }
+    )
+
+async def run_detailed_attacks(
+    job_id: str,
+    security_test: SecurityTest,
+    run_metrics: RunMetrics,
+    tracer: Optional[Tracer] = None,
+):
+    def save_tree(index: int, scenario: str, leaf_nodes: List[SecurityTest.Node]):
+        # The tree is written before the event that announces it
+        event_writer.add_tree(job_id, index, scenario, [node.to_dict() for node in leaf_nodes])
+        event_writer.add_event(
+            job_id, "tree_complete", {"scenario_index": index, "scenario": scenario}
+        )
 
-async def run_detailed_attacks(security_test: SecurityTest):
-    results = security_test.run()
-    # Save detailed attack results in cache
-    test_results_cache[security_test.system_prompt]["attacks"] = results
+    # This job runs on the event loop, so its store writes go to a thread
+    await asyncio.to_thread(job_store.update_job, job_id, status="running")
+    started = time.monotonic()
+    try:
+        with collect_run(run_metrics), tracing(tracer), span("attack_run", "job", job_id=job_id):
+            results = await security_test.arun(on_tree_complete=save_tree)
+    except Exception as e:
+        metrics.record_job("attack", "failed", time.monotonic() - started)
+        await asyncio.to_thread(event_writer.flush)
+        await asyncio.to_thread(job_store.update_job, job_id, status="failed", error=str(e))
+        raise
+    finally:
+        await asyncio.to_thread(export_job_trace, tracer, job_id)
+    metrics.record_job("attack", "done", time.monotonic() - started)
+    await asyncio.to_thread(event_writer.flush)
+    await asyncio.to_thread(
+        job_store.update_job,
+        job_id,
+        status="done",
+        result={
+            "results": results,
+            "stats": security_test.stats(),
+            "metrics": run_metrics.summary(),
+        },
+    )
 
 @app.get("/get_attack_results/")
-async def get_attack_results(system_prompt: str):
-    results = test_results_cache.get(system_prompt, {}).get("attacks")
-    if results is None:
-        return JSONResponse(status_code=202, content={"status": "Still processing"})
-    return JSONResponse(content={"results": results})
+async def get_attack_results(job_id: Optional[str] = None, system_prompt: Optional[str] = None):
+    job = await resolve_job("attack", job_id, system_prompt)
+    if job["status"] != "done":
+        return pending_response(job)
+    return JSONResponse(content={"job_id": job["id"], **job["result"]})
 
 @app.post("/initiate_defense_test/")
-async def initiate_defense_test(input_data: SecurityDefenseTestInput, background_tasks: BackgroundTasks):
-    # Assuming defense test requires completed attack results
-    if "attacks" not in test_results_cache[input_data.system_prompt]:
+async def initiate_defense_test(input_data: SecurityDefenseTestInput, request: Request):
+    # Defense test requires completed attack results
+    attack_job = await resolve_job("attack", input_data.attack_job_id, input_data.system_prompt)
+    if attack_job["status"] != "done":
         raise HTTPException(status_code=400, detail="Attack results must be generated first.")
+    if input_data.selection not in SELECTION_MODES:
+        raise HTTPException(status_code=400, detail=f"selection must be one of {SELECTION_MODES}")
+    if input_data.race_eta < 2:
+        raise HTTPException(status_code=400, detail="race_eta must be at least 2")
+
+    job_id, created = await asyncio.to_thread(
+        job_store.claim_job, "defense", input_data.system_prompt, input_data.model_dump()
+    )
 
-    # Background task to run defense simulations
-    background_tasks.add_task(run_defense_simulations, input_data)
-    return JSONResponse(status_code=202, content={"status": "Defense simulation initiated"})
-
-async def run_defense_simulations(input_data: SecurityDefenseTestInput):
-    results, stats = def_run_security_test(
-        input_data.system_prompt,
-        input_data.attack_scenarios,
-        input_data.attack_prompts,
-        input_data.branching_factor,
-        input_data.max_width,
-        input_data.max_depth,
-        input_data.top_k,
+    # Defense search is synchronous, so it runs on the job worker pool
+    if created:
+        await admit_job(job_id, request)
+        job_runner.submit(job_id, run_defense_simulations, job_id, input_data)
+    return JSONResponse(
+        status_code=202,
+        content={
+            "job_id": job_id,
+            "status": "Defense simulation initiated",
+            "coalesced": not created,
+            "queue": queue_info(job_id),
+        },
+    )
+
+def run_defense_simulations(job_id: str, input_data: SecurityDefenseTestInput):
+    job_store.update_job(job_id, status="running")
+    started = time.monotonic()
+    tracer = job_tracer("defense", job_id)
+    try:
+        with collect_run(RunMetrics()) as run_metrics, tracing(tracer), span(
+            "defense_run", "job", job_id=job_id
+        ):
+            results, stats = def_run_security_test(
+                input_data.system_prompt,
+                input_data.attack_scenarios,
+                input_data.attack_prompts,
+                input_data.branching_factor,
+                input_data.max_width,
+                input_data.max_depth,
+                input_data.top_k,
+                input_data.success_threshold,
+                input_data.prune_above,
+                input_data.patience,
+                input_data.selection,
+                input_data.race_eta,
+                input_data.race_initial_per_scenario,
+                job_events(job_id),
+            )
+    except Exception as e:
+        metrics.record_job("defense", "failed", time.monotonic() - started)
+        event_writer.flush()
+        job_store.update_job(job_id, status="failed", error=str(e))
+        raise
+    finally:
+        export_job_trace(tracer, job_id)
+    metrics.record_job("defense", "done", time.monotonic() - started)
+    event_writer.flush()
+    # Save the best defense and the run statistics with the job
+    job_store.update_job(
+        job_id,
+        status="done",
+        result={
+            "results": results[0].to_dict() if results else None,
+            "stats": stats,
+            "metrics": run_metrics.summary(),
+        },
     )
-    # Save defense results in cache
-    test_results_cache[input_data.system_prompt]["defenses"] = {"results": results[0], "stats": stats}
 
 @app.get("/get_defense_results/")
-async def get_defense_results(system_prompt: str):
-    results = test_results_cache.get(system_prompt, {}).get("defenses")
-    if results is None:
-        return JSONResponse(status_code=202, content={"status": "Still processing"})
-    return JSONResponse(content=results)
+async def get_defense_results(job_id: Optional[str] = None, system_prompt: Optional[str] = None):
+    job = await resolve_job("defense", job_id, system_prompt)
+    if job["status"] != "done":
+        return pending_response(job)
+    return JSONResponse(content={"job_id": job["id"], **job["result"]})
+
+@app.get("/job_events/")
+async def get_job_events(
+    job_id: str,
+    cursor: int = 0,
+    last_event_id: Optional[str] = Header(default=None),
+):
+    """Server-sent events with the progress of an attack or defense job.
+
+    Events are replayed from after `cursor` (or the Last-Event-ID header an
+    EventSource sends on reconnect) and the stream ends after the final
+    "status" event.
+    """
+    if await asyncio.to_thread(job_store.get_status, job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired.")
+    if last_event_id and last_event_id.isdigit():
+        cursor = int(last_event_id)
+    return StreamingResponse(
+        event_stream(job_id, cursor),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/queue_status/")
+async def get_queue_status():
+    return JSONResponse(content=job_runner.stats())
+
+@app.get("/job_trace/")
+async def get_job_trace(job_id: str):
+    # Chrome trace of a job, written when the server runs with TRACE_DIR set
+    if await asyncio.to_thread(job_store.get_status, job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired.")
+    path = trace_path(job_id)
+    if path is None or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="No trace for this job.")
+    return FileResponse(path, media_type="application/json", filename=f"{job_id}.json")
+
+@app.get("/metrics")
+async def get_metrics():
+    # Prometheus text format; per-job breakdowns are stored with each result
+    queue = job_runner.stats()
+    metrics.jobs_active.set(queue["queued"], state="queued")
+    metrics.jobs_active.set(queue["running"], state="running")
+    gateway = llm_gateway.stats()
+    metrics.llm_concurrency.set(gateway["concurrency_limit"], kind="limit")
+    metrics.llm_concurrency.set(gateway["in_flight"], kind="in_flight")
+    logs = log_sink.stats()
+    metrics.log_records.set(logs["queued"], state="queued")
+    metrics.log_records.set(logs["dropped"], state="dropped")
+    return PlainTextResponse(
+        metrics.registry.render(), media_type="text/plain; version=0.0.4"
+    )
+
+@app.get("/llm_cache_stats/")
+async def get_llm_cache_stats():
+    return JSONResponse(
+        content={
+            **llm_cache.stats(),
+            "judge_memo": judge_memo.stats(),
+            "gateway": llm_gateway.stats(),
+            "cassette": llm_cassette.stats() if llm_cassette is not None else None,
+        }
+    )
@@ -0,0 +1,333 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Seconds; LLM calls run from well under a second to minutes
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def label_text(labelnames: Sequence[str], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self.lock:
+            values = sorted(self.values.items(), key=lambda item: tuple(map(str, item[0])))
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in values:
+            lines.append(f"{self.name}{label_text(self.labelnames, key)} {format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, value: float, **labels: Any) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.lock:
+            self.values[key] = value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+        # labels -> (per-bucket counts, sum)
+        self.values: Dict[Tuple, Tuple[List[int], float]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.lock:
+            counts, total = self.values.get(key) or ([0] * len(self.buckets), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    def render(self) -> List[str]:
+        with self.lock:
+            values = sorted(
+                ((key, list(counts), total) for key, (counts, total) in self.values.items()),
+                key=lambda item: tuple(map(str, item[0])),
+            )
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{format_value(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{label_text(self.labelnames, key, le)} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{label_text(self.labelnames, key)} {format_value(total)}")
+            lines.append(f"{self.name}_count{label_text(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Process-wide metrics in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self.metrics: List[Any] = []
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def register(self, metric: Any) -> Any:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+class RunMetrics:
+    """Where the wall time and LLM budget of one job went.
+
+    Collects LLM calls by stage, scenario and depth, and search steps by
+    depth, for whatever runs inside collect_run(). summary() is what gets
+    stored with the job result.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.scenarios: Dict[str, Dict[str, float]] = {}
+        self.depths: Dict[str, Dict[str, float]] = {}
+
+    @staticmethod
+    def bump(table: Dict[str, Dict[str, float]], key: str, **amounts: float) -> Dict[str, float]:
+        row = table.setdefault(key, {})
+        for name, amount in amounts.items():
+            row[name] = row.get(name, 0) + amount
+        return row
+
+    def record_call(
+        self,
+        stage: str,
+        seconds: float,
+        input_tokens: int,
+        output_tokens: int,
+        failed: bool,
+        scenario: Optional[str],
+        depth: Optional[int],
+    ) -> None:
+        usage = {
+            "llm_calls": 1,
+            "llm_seconds": seconds,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+        }
+        with self.lock:
+            row = self.bump(self.stages, stage, errors=int(failed), **usage)
+            row["max_seconds"] = max(row.get("max_seconds", 0.0), seconds)
+            if scenario is not None:
+                self.bump(self.scenarios, scenario, **usage)
+            if depth is not None:
+                self.bump(self.depths, str(depth), **usage)
+
+    def record_step(self, depth: Optional[int], seconds: float) -> None:
+        with self.lock:
+            self.bump(self.depths, depth_label(depth), steps=1, step_seconds=seconds)
+
+    def summary(self) -> Dict[str, Any]:
+        with self.lock:
+            stages = {name: dict(row) for name, row in self.stages.items()}
+            scenarios = {name: dict(row) for name, row in self.scenarios.items()}
+            depths = {name: dict(row) for name, row in self.depths.items()}
+        for row in stages.values():
+            row["mean_seconds"] = row["llm_seconds"] / row["llm_calls"]
+        return {
+            "wall_seconds": time.monotonic() - self.started,
+            "llm_calls": sum(row["llm_calls"] for row in stages.values()),
+            "stages": stages,
+            "scenarios": scenarios,
+            "depths": depths,
+        }
+
+
+class RunTallies:
+    """Per-run counts for components every run in the process shares.
+
+    The judge memo and pre-judge keep lifetime counters of their own; work
+    done inside collect_tallies() is also counted here, so concurrent runs
+    don't report each other's calls.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.groups: Dict[str, Dict[str, float]] = {}
+
+    def add(self, group: str, name: str, amount: float = 1) -> None:
+        with self.lock:
+            RunMetrics.bump(self.groups, group, **{name: amount})
+
+    def get(self, group: str) -> Dict[str, float]:
+        with self.lock:
+            return dict(self.groups.get(group, {}))
+
+
+def depth_label(depth: Optional[int]) -> str:
+    # Best-first steps can mix depths
+    return "mixed" if depth is None else str(depth)
+
+
+registry = MetricsRegistry()
+llm_calls = registry.counter(
+    "tap_llm_calls_total", "LLM calls by pipeline stage and outcome.", ("stage", "outcome")
+)
+llm_seconds = registry.histogram(
+    "tap_llm_call_seconds", "LLM call latency, including gateway retries.", ("stage",)
+)
+llm_tokens = registry.counter(
+    "tap_llm_tokens_total", "LLM tokens by stage, input or output.", ("stage", "direction")
+)
+step_seconds = registry.histogram(
+    "tap_search_step_seconds",
+    "Wall time of one search step (a level, a best-first batch or one expansion).",
+    ("search", "depth"),
+)
+search_nodes = registry.counter(
+    "tap_search_nodes_total", "Search tree nodes by event.", ("search", "event")
+)
+jobs_finished = registry.counter("tap_jobs_total", "Finished jobs.", ("kind", "status"))
+job_seconds = registry.histogram(
+    "tap_job_seconds",
+    "Job run time.",
+    ("kind",),
+    buckets=(10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1200.0, 3600.0),
+)
+# Gauges are filled in when /metrics is scraped
+jobs_active = registry.gauge("tap_jobs_active", "Jobs by queue state.", ("state",))
+llm_concurrency = registry.gauge(
+    "tap_llm_concurrency", "Gateway concurrency limit and requests in flight.", ("kind",)
+)
+log_records = registry.gauge(
+    "tap_log_records", "Log records waiting to be written, and dropped so far.", ("state",)
+)
+
+# Per-job collector and the tree position of the code currently running;
+# both follow asyncio tasks and langchain's batch threads automatically
+current_run: ContextVar[Optional[RunMetrics]] = ContextVar("current_run", default=None)
+current_tallies: ContextVar[Optional[RunTallies]] = ContextVar("current_tallies", default=None)
+current_node: ContextVar[Tuple[Optional[str], Optional[int]]] = ContextVar(
+    "current_node", default=(None, None)
+)
+
+
+@contextmanager
+def collect_run(run: RunMetrics) -> Iterator[RunMetrics]:
+    token = current_run.set(run)
+    try:
+        yield run
+    finally:
+        current_run.reset(token)
+
+
+@contextmanager
+def collect_tallies() -> Iterator[RunTallies]:
+    tallies = RunTallies()
+    token = current_tallies.set(tallies)
+    try:
+        yield tallies
+    finally:
+        current_tallies.reset(token)
+
+
+@contextmanager
+def node_labels(scenario: Optional[str], depth: Optional[int]) -> Iterator[None]:
+    token = current_node.set((scenario, depth))
+    try:
+        yield
+    finally:
+        current_node.reset(token)
+
+
+def record_llm_call(
+    stage: str, seconds: float, input_tokens: int, output_tokens: int, failed: bool = False
+) -> None:
+    llm_calls.inc(stage=stage, outcome="error" if failed else "ok")
+    llm_seconds.observe(seconds, stage=stage)
+    llm_tokens.inc(input_tokens, stage=stage, direction="input")
+    llm_tokens.inc(output_tokens, stage=stage, direction="output")
+    run = current_run.get()
+    if run is not None:
+        scenario, depth = current_node.get()
+        run.record_call(stage, seconds, input_tokens, output_tokens, failed, scenario, depth)
+
+
+def tally(group: str, name: str, amount: float = 1) -> None:
+    tallies = current_tallies.get()
+    if tallies is not None:
+        tallies.add(group, name, amount)
+
+
+def record_step(search: str, depth: Optional[int], seconds: float) -> None:
+    step_seconds.observe(seconds, search=search, depth=depth_label(depth))
+    run = current_run.get()
+    if run is not None:
+        run.record_step(depth, seconds)
+
+
+def record_nodes(search: str, event: str, count: int = 1) -> None:
+    search_nodes.inc(count, search=search, event=event)
+
+
+def record_job(kind: str, status: str, seconds: float) -> None:
+    jobs_finished.inc(kind=kind, status=status)
+    job_seconds.observe(seconds, kind=kind)
@@ -1,15 +1,11 @@
-import os
-from langchain_mistralai import ChatMistralAI
 from langchain.prompts import ChatPromptTemplate
 from langchain.schema.runnable import RunnablePassthrough
 
+from llm_gateway import llm_gateway
 
-# Initialize the Mistral AI language model
-llm = ChatMistralAI(
-    model="mistral-large-latest",
-    max_retries=2,
-    api_key=os.environ["MISTRAL_API_KEY"],
-)
+
+# Shared, rate-limited Mistral client (see llm_gateway.py)
+llm = llm_gateway
 
 template = """You are a mortgage lender customer service bot, and your task is to create personalized email responses to address customer questions. 
 Answer the customer's inquiry using the provided facts below. 
@@ -0,0 +1,42 @@
+import re
+from typing import AsyncIterator, Iterator, List
+
+BLOCK_PATTERN = re.compile(r"-----(.+?)-----", re.DOTALL)
+
+
+class PromptBlockParser:
+    """Incremental version of re.findall(r"-----(.+?)-----", output, re.DOTALL).
+
+    Text is fed chunk by chunk and every block is returned as soon as its
+    closing delimiter arrives. Blocks come out exactly as the batch regex
+    would return them on the full output, stripped and without empty ones.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, chunk: str) -> List[str]:
+        self.buffer += chunk
+        prompts = []
+        while True:
+            match = BLOCK_PATTERN.search(self.buffer)
+            if match is None:
+                break
+            self.buffer = self.buffer[match.end():]
+            prompt = match.group(1).strip()
+            if prompt:
+                prompts.append(prompt)
+        return prompts
+
+
+def iter_prompt_blocks(chunks: Iterator) -> Iterator[str]:
+    parser = PromptBlockParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk.content)
+
+
+async def aiter_prompt_blocks(chunks: AsyncIterator) -> AsyncIterator[str]:
+    parser = PromptBlockParser()
+    async for chunk in chunks:
+        for prompt in parser.feed(chunk.content):
+            yield prompt
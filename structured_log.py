@@ -0,0 +1,212 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from metrics import current_node
+from utils.pretty_print import colored_text
+
+LOG_FORMATS = ("json", "console")
+# Parent of every search logger; uvicorn and library logs are left alone
+ROOT_LOGGER = "tap"
+
+
+def truncate(value: Any, max_chars: int) -> Any:
+    # Long strings keep their head and note the original length; 0 keeps all
+    if not max_chars or not isinstance(value, str) or len(value) <= max_chars:
+        return value
+    return f"{value[:max_chars]}... [{len(value)} chars]"
+
+
+class EventLogger:
+    """Structured events on top of a stdlib logger.
+
+    Each event is a short message plus keyword fields, tagged with the
+    scenario and depth of the search node being expanded. Below the
+    configured level a call is a single level check, so full prompts and
+    responses can be logged at debug level from the hot loops. `color`
+    only affects the console sink.
+    """
+
+    def __init__(self, name: str):
+        self.logger = logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+    def log(
+        self,
+        level: int,
+        event: str,
+        color: Optional[str] = None,
+        exc_info: bool = False,
+        **fields: Any,
+    ) -> None:
+        if not self.logger.isEnabledFor(level):
+            return
+        scenario, depth = current_node.get()
+        if scenario is not None:
+            fields.setdefault("scenario", scenario)
+        if depth is not None:
+            fields.setdefault("depth", depth)
+        self.logger.log(level, event, exc_info=exc_info, extra={"fields": fields, "color": color})
+
+    def debug(self, event: str, color: Optional[str] = None, **fields: Any) -> None:
+        self.log(logging.DEBUG, event, color, **fields)
+
+    def info(self, event: str, color: Optional[str] = None, **fields: Any) -> None:
+        self.log(logging.INFO, event, color, **fields)
+
+    def warning(self, event: str, color: Optional[str] = None, **fields: Any) -> None:
+        self.log(logging.WARNING, event, color, **fields)
+
+    def exception(self, event: str, color: Optional[str] = None, **fields: Any) -> None:
+        # Error level, with the traceback of the exception being handled
+        self.log(logging.ERROR, event, color, exc_info=True, **fields)
+
+
+def get_logger(name: str) -> EventLogger:
+    return EventLogger(name)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, string fields cut to max_chars."""
+
+    def __init__(self, max_chars: int):
+        super().__init__()
+        self.max_chars = max_chars
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        for name, value in getattr(record, "fields", {}).items():
+            entry[name] = truncate(value, self.max_chars)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ConsoleFormatter(logging.Formatter):
+    """Colored `event key=value ...` lines, like the old colored_print output."""
+
+    def __init__(self, max_chars: int):
+        super().__init__()
+        self.max_chars = max_chars
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = " ".join(
+            f"{name}={truncate(value, self.max_chars)}"
+            for name, value in getattr(record, "fields", {}).items()
+        )
+        text = f"{record.getMessage()} {fields}" if fields else record.getMessage()
+        color = getattr(record, "color", None)
+        if color is None and record.levelno >= logging.WARNING:
+            color = "Y"
+        if record.exc_info:
+            text = f"{text}\n{self.formatException(record.exc_info)}"
+        return colored_text(text, color) if color else text
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the sink thread without ever blocking the caller.
+
+    Formatting happens on the sink thread; the record is queued as is. When
+    the queue is full the record is dropped and counted instead of making
+    the search wait for log I/O.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Handler.handle() holds the handler lock around this
+            self.dropped += 1
+
+
+class DrainingQueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self) -> None:
+        # Waits for room so stop() still works when the queue is full
+        self.queue.put(self._sentinel)
+
+
+class LogSink:
+    """The queue, its writer thread and the handler they feed."""
+
+    def __init__(
+        self,
+        level: str = "INFO",
+        format: str = "json",
+        max_chars: int = 300,
+        queue_size: int = 10000,
+        path: Optional[str] = None,
+        max_file_mb: float = 50.0,
+        backups: int = 3,
+    ):
+        if format not in LOG_FORMATS:
+            raise ValueError(f"Unknown log format {format!r}, expected one of {LOG_FORMATS}")
+        self.format = format
+        if path:
+            # Rotated so long-running servers keep a bounded amount of logs
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=int(max_file_mb * 2**20), backupCount=backups, encoding="utf-8"
+            )
+        else:
+            handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(
+            JsonFormatter(max_chars) if format == "json" else ConsoleFormatter(max_chars)
+        )
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.handler = DroppingQueueHandler(self.queue)
+        self.listener = DrainingQueueListener(self.queue, handler)
+
+        self.logger = logging.getLogger(ROOT_LOGGER)
+        self.logger.setLevel(level.upper())
+        self.logger.addHandler(self.handler)
+        self.logger.propagate = False
+        self.listener.start()
+        self.running = True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "format": self.format,
+            "level": logging.getLevelName(self.logger.level),
+            "queued": self.queue.qsize(),
+            "dropped": self.handler.dropped,
+        }
+
+    def stop(self) -> None:
+        # Writes out whatever is still queued; later records are discarded
+        if self.running:
+            self.running = False
+            self.logger.removeHandler(self.handler)
+            self.listener.stop()
+
+
+def log_sink_from_env() -> LogSink:
+    return LogSink(
+        level=os.environ.get("LOG_LEVEL", "INFO"),
+        format=os.environ.get("LOG_FORMAT", "json"),
+        max_chars=int(os.environ.get("LOG_MAX_CHARS", "300")),
+        queue_size=int(os.environ.get("LOG_QUEUE_SIZE", "10000")),
+        path=os.environ.get("LOG_FILE"),
+        max_file_mb=float(os.environ.get("LOG_FILE_MAX_MB", "50")),
+    )
+
+
+log_sink = log_sink_from_env()
+atexit.register(log_sink.stop)
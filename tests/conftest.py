@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# Modules build their singletons at import time: the gateway needs a key it
+# never uses offline, and the job store and LLM cache must not touch the
+# working tree
+os.environ.setdefault("MISTRAL_API_KEY", "offline-tests")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("LLM_CACHE_DISABLED", "1")
+os.environ.setdefault("JOB_STORE_PATH", os.path.join(tempfile.mkdtemp(), "jobs.sqlite3"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
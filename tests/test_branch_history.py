@@ -0,0 +1,94 @@
+import pytest
+
+from attack_tap import SecurityTest
+from branch_history import HistoryCompactor, chars_to_tokens
+
+Node = SecurityTest.Node
+
+
+def build_branch(results):
+    # results: (prompt, (model_response, score, feedback) or None) per level
+    node = Node("", None, 0, "goal")
+    for node_id, (prompt, result) in enumerate(results, start=1):
+        node = Node(prompt, node, node_id, "goal")
+        if result is not None:
+            node.set_result(*result)
+    return node
+
+
+def old_history(results):
+    # conversation_history as the attack tree built it before compaction
+    history = []
+    for prompt, result in results:
+        history.append(prompt)
+        if result is not None:
+            model_response, score, feedback = result
+            history.append(f"Model: {model_response}")
+            history.append(f"Judge Score: {score}")
+            history.append(f"Judge Feedback: {feedback}")
+    return "\n".join(history)
+
+
+BRANCHES = [
+    [("only prompt", None)],
+    [("first", ("answer one", 3, "weak")), ("second", None)],
+    [
+        ("first", ("answer\nover lines", 2, "try harder")),
+        ("second", ("answer two", 7, "closer")),
+        ("third", ("answer three", 5, "")),
+        ("fourth", None),
+    ],
+]
+
+
+@pytest.mark.parametrize("results", BRANCHES)
+def test_full_matches_old_join(results):
+    node = build_branch(results)
+    assert HistoryCompactor("full").compact(node) == old_history(results)
+    assert node.history_chars == len(old_history(results))
+
+
+def test_history_chars_follow_set_result():
+    results = BRANCHES[2]
+    node = build_branch(results[:-1] + [("fourth", None)])
+    node.set_result("late answer", 9, "done")
+    expected = old_history(results[:-1] + [("fourth", ("late answer", 9, "done"))])
+    assert HistoryCompactor().compact(node) == expected
+    assert node.history_chars == len(expected)
+
+
+def test_last_n_keeps_the_latest_turns():
+    results = BRANCHES[2]
+    history = HistoryCompactor("last_n", max_turns=2).compact(build_branch(results))
+    assert history == old_history(results[-2:])
+
+
+def test_best_scored_keeps_path_order():
+    results = BRANCHES[2]
+    history = HistoryCompactor("best_scored", max_turns=2).compact(build_branch(results))
+    assert history == old_history([results[1], results[2]])
+
+
+def test_max_tokens_drops_oldest_turns_but_keeps_the_last():
+    results = BRANCHES[2]
+    node = build_branch(results)
+    compactor = HistoryCompactor("full", max_tokens=1)
+    assert compactor.compact(node) == "fourth"
+
+    budget = chars_to_tokens(len(old_history(results[-2:])))
+    assert HistoryCompactor("full", max_tokens=budget).compact(node) == old_history(results[-2:])
+
+
+def test_stats_count_saved_tokens():
+    node = build_branch(BRANCHES[2])
+    compactor = HistoryCompactor("last_n", max_turns=1)
+    history = compactor.compact(node)
+    stats = compactor.stats()
+    assert stats["calls"] == 1
+    assert stats["history_tokens_full"] == chars_to_tokens(node.history_chars)
+    assert stats["history_tokens_sent"] == chars_to_tokens(len(history))
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        HistoryCompactor("everything")
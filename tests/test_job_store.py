@@ -0,0 +1,159 @@
+import threading
+import time
+
+import pytest
+
+import tracing
+from job_store import EventWriter, JobStore, canonical_hash
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.sqlite3"), ttl_seconds=60, max_jobs=3)
+
+
+def finish(store, job_id, status="done"):
+    store.update_job(job_id, status=status)
+
+
+def test_identical_inputs_share_a_job(store):
+    params = {"max_depth": 3, "width": 2}
+    job_id, created = store.claim_job("attack", "prompt", params)
+    assert created
+    assert store.claim_job("attack", "prompt", {"width": 2, "max_depth": 3}) == (job_id, False)
+    finish(store, job_id)
+    assert store.claim_job("attack", "prompt", params) == (job_id, False)
+
+
+def test_different_inputs_get_new_jobs(store):
+    job_id, _ = store.claim_job("attack", "prompt", {"width": 2})
+    other, created = store.claim_job("attack", "prompt", {"width": 3})
+    assert created and other != job_id
+    defense, created = store.claim_job("defense", "prompt", {"width": 2})
+    assert created and defense != job_id
+
+
+def test_failed_jobs_are_not_reused(store):
+    job_id, _ = store.claim_job("attack", "prompt", {})
+    finish(store, job_id, "failed")
+    retry, created = store.claim_job("attack", "prompt", {})
+    assert created and retry != job_id
+
+
+def test_expired_jobs_are_not_reused(store):
+    store.ttl_seconds = 0.05
+    job_id, _ = store.claim_job("attack", "prompt", {})
+    finish(store, job_id)
+    time.sleep(0.1)
+    assert store.get_status(job_id) is None
+    retry, created = store.claim_job("attack", "prompt", {})
+    assert created and retry != job_id
+
+
+def test_unfinished_jobs_do_not_expire(store):
+    store.ttl_seconds = 0.05
+    job_id, _ = store.claim_job("attack", "prompt", {})
+    store.update_job(job_id, status="running")
+    time.sleep(0.1)
+    assert store.get_status(job_id) == "running"
+    assert store.claim_job("attack", "prompt", {}) == (job_id, False)
+
+
+def test_stale_unfinished_jobs_are_failed_not_joined(store):
+    job_id, _ = store.claim_job("attack", "prompt", {})
+    store.lease_seconds = 0
+    time.sleep(0.01)
+    retry, created = store.claim_job("attack", "prompt", {})
+    assert created and retry != job_id
+    assert store.get_status(job_id) == "failed"
+
+
+def test_concurrent_claims_end_up_on_one_job(store):
+    results = []
+
+    def claim():
+        results.append(store.claim_job("attack", "prompt", {"width": 2}))
+
+    threads = [threading.Thread(target=claim) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({job_id for job_id, _ in results}) == 1
+    assert sum(created for _, created in results) == 1
+
+
+def test_evict_caps_finished_jobs_and_keeps_unfinished(store):
+    running, _ = store.claim_job("attack", "prompt", {"n": -1})
+    store.update_job(running, status="running")
+    finished = []
+    for n in range(4):
+        job_id, _ = store.claim_job("attack", "prompt", {"n": n})
+        finish(store, job_id)
+        finished.append(job_id)
+    store.evict()
+
+    assert store.get_status(running) == "running"
+    # max_jobs=3 with one unfinished job leaves room for the two newest
+    assert [store.get_job(job_id) is not None for job_id in finished] == [
+        False, False, True, True,
+    ]
+    assert store.get_events(finished[0]) == []
+
+
+def test_evict_listeners_delete_traces(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, "TRACE_DIR", str(tmp_path))
+    store.evict_listeners.append(tracing.delete_job_traces)
+    store.ttl_seconds = 0.05
+    old, _ = store.claim_job("attack", "prompt", {"n": 0})
+    finish(store, old)
+    running, _ = store.claim_job("attack", "prompt", {"n": 1})
+    for job_id in (old, running):
+        with open(tracing.trace_path(job_id), "w") as f:
+            f.write("{}")
+    time.sleep(0.1)
+    store.evict()
+
+    assert not (tmp_path / f"{old}.json").exists()
+    assert (tmp_path / f"{running}.json").exists()
+
+
+def test_canonical_hash_ignores_key_order():
+    assert canonical_hash({"a": 1, "b": [1, 2]}) == canonical_hash({"b": [1, 2], "a": 1})
+    assert canonical_hash({"a": 1}) != canonical_hash({"a": 2})
+
+
+def test_event_writer_flush_writes_queued_events(store):
+    writer = EventWriter(store)
+    job_id, _ = store.claim_job("attack", "prompt", {})
+    for i in range(50):
+        writer.add_event(job_id, "progress", {"i": i})
+    writer.add_tree(job_id, 0, "scenario", [{"node_id": 1}])
+    writer.flush()
+
+    events = store.get_events(job_id)
+    assert [e["data"]["i"] for e in events if e["type"] == "progress"] == list(range(50))
+    assert store.get_job(job_id)["trees"][0]["nodes"] == [{"node_id": 1}]
+
+
+def test_event_writer_flush_does_not_wait_for_later_events(store):
+    writer = EventWriter(store)
+    job_id, _ = store.claim_job("attack", "prompt", {"n": 0})
+    other, _ = store.claim_job("attack", "prompt", {"n": 1})
+    stop = threading.Event()
+
+    def busy():
+        while not stop.is_set():
+            writer.add_event(other, "progress", {})
+
+    thread = threading.Thread(target=busy)
+    thread.start()
+    try:
+        writer.add_event(job_id, "progress", {})
+        done = threading.Event()
+        threading.Thread(target=lambda: (writer.flush(), done.set())).start()
+        assert done.wait(10)
+    finally:
+        stop.set()
+        thread.join()
+    assert len(store.get_events(job_id)) == 2
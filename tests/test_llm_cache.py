@@ -0,0 +1,106 @@
+import asyncio
+import os
+import time
+
+import pytest
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+
+from llm_cache import CachedRunnable, LLMCache
+
+
+def key(n):
+    return f"{n:064x}"
+
+
+def wait_for_sweep(cache):
+    deadline = time.time() + 5
+    while cache.sweeping and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_memory_lru_evicts_least_recently_used(tmp_path):
+    cache = LLMCache(str(tmp_path), max_memory_entries=2)
+    for n in range(3):
+        cache.set(key(n), f"value {n}")
+    assert list(cache.memory) == [key(1), key(2)]
+
+    cache.get(key(1))
+    cache.set(key(3), "value 3")
+    assert list(cache.memory) == [key(1), key(3)]
+    # Entries evicted from memory are still on disk
+    assert cache.get(key(0)) == "value 0"
+    assert cache.stats()["disk_hits"] == 1
+
+
+def test_disk_budget_evicts_oldest_entries(tmp_path):
+    cache = LLMCache(str(tmp_path), max_disk_bytes=2000)
+    for n in range(100):
+        cache.set(key(n), "x" * 100)
+        wait_for_sweep(cache)
+    cache.sweep()
+
+    stats = cache.stats()
+    assert stats["disk_bytes"] <= 2000
+    assert stats["disk_evictions"] > 0
+    cache.memory.clear()
+    assert cache.get(key(99)) == "x" * 100
+    assert cache.get(key(0)) is None
+
+
+def test_ttl_expires_disk_and_memory_entries(tmp_path):
+    cache = LLMCache(str(tmp_path), ttl_seconds=0.1)
+    cache.set(key(0), "fresh")
+    assert cache.get(key(0)) == "fresh"
+    time.sleep(0.2)
+    assert cache.get(key(0)) is None
+    assert key(0) not in cache.memory
+
+    cache.sweep()
+    assert not os.path.exists(cache.path_for(key(0)))
+
+
+def test_memory_entry_is_as_old_as_its_file(tmp_path):
+    cache = LLMCache(str(tmp_path), ttl_seconds=60)
+    cache.set(key(0), "old")
+    old = time.time() - 120
+    os.utime(cache.path_for(key(0)), (old, old))
+    cache.memory.clear()
+    assert cache.get(key(0)) is None
+
+
+def test_disabled_cache_stores_nothing(tmp_path):
+    cache = LLMCache(str(tmp_path), enabled=False)
+    cache.set(key(0), "value")
+    assert cache.get(key(0)) is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_async_tier_round_trip(tmp_path):
+    cache = LLMCache(str(tmp_path))
+
+    async def run():
+        await cache.aset(key(0), "value")
+        cache.memory.clear()
+        return await cache.aget(key(0)), await cache.aget(key(0))
+
+    assert asyncio.run(run()) == ("value", "value")
+    stats = cache.stats()
+    assert (stats["disk_hits"], stats["memory_hits"]) == (1, 1)
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_cached_runnable_calls_the_model_once(tmp_path, use_async):
+    calls = []
+
+    def model(prompt):
+        calls.append(prompt)
+        return AIMessage(content=f"reply to {prompt}")
+
+    runnable = CachedRunnable(RunnableLambda(model), LLMCache(str(tmp_path)), "fake")
+    if use_async:
+        replies = [asyncio.run(runnable.ainvoke("hello")) for _ in range(3)]
+    else:
+        replies = [runnable.invoke("hello") for _ in range(3)]
+    assert [r.content for r in replies] == ["reply to hello"] * 3
+    assert calls == ["hello"]
@@ -0,0 +1,57 @@
+import re
+
+import pytest
+from langchain_core.messages import AIMessageChunk
+
+from prompt_stream import PromptBlockParser, iter_prompt_blocks
+
+OUTPUTS = [
+    "-----first prompt-----\n-----second\nprompt-----",
+    "Here you go:\n-----  padded  -----\ntrailing text",
+    "----------\n-----after empty-----",
+    "-----one----------two-----",
+    "-----unterminated",
+    "no blocks at all",
+    "---- not a delimiter -----real-----",
+]
+
+
+def findall(output):
+    # What the attacker chains did before streaming
+    return [p.strip() for p in re.findall(r"-----(.+?)-----", output, re.DOTALL) if p.strip()]
+
+
+def feed_all(chunks):
+    parser = PromptBlockParser()
+    return [prompt for chunk in chunks for prompt in parser.feed(chunk)]
+
+
+@pytest.mark.parametrize("output", OUTPUTS)
+def test_whole_output_matches_findall(output):
+    assert feed_all([output]) == findall(output)
+
+
+@pytest.mark.parametrize("output", OUTPUTS)
+def test_every_split_point_matches_findall(output):
+    # Two chunks split everywhere, including inside the ----- delimiters
+    for cut in range(len(output) + 1):
+        assert feed_all([output[:cut], output[cut:]]) == findall(output), cut
+
+
+@pytest.mark.parametrize("output", OUTPUTS)
+def test_single_character_chunks_match_findall(output):
+    assert feed_all(list(output)) == findall(output)
+
+
+def test_blocks_come_out_when_their_delimiter_closes():
+    parser = PromptBlockParser()
+    assert parser.feed("-----first pro") == []
+    assert parser.feed("mpt---") == []
+    assert parser.feed("--\n---") == ["first prompt"]
+    assert parser.feed("--second-----") == ["second"]
+
+
+def test_iter_prompt_blocks_reads_chunk_content():
+    output = "-----a-----\n-----b-----"
+    chunks = [AIMessageChunk(content=output[i:i + 3]) for i in range(0, len(output), 3)]
+    assert list(iter_prompt_blocks(iter(chunks))) == ["a", "b"]
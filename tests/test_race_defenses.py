@@ -0,0 +1,90 @@
+import random
+
+import numpy as np
+import pytest
+
+import defense_tap
+from defense_tap import race_defenses
+
+SCENARIOS = ["scenario 0", "scenario 1", "scenario 2"]
+ATTACKS = {
+    scenario: [f"{scenario} attack {i}" for i in range(size)]
+    for scenario, size in zip(SCENARIOS, (8, 4, 6))
+}
+DEFENSES = [f"defense {i}" for i in range(9)]
+
+
+def cell_score(defense, attack):
+    # Lower is better; defense i scores about i, with per-attack noise
+    index = int(defense.split()[-1])
+    noise = random.Random(f"{defense}|{attack}").random()
+    return float(index) + noise
+
+
+@pytest.fixture
+def evaluated(monkeypatch):
+    cells = []
+
+    def evaluate_cells(batch, system_prompt):
+        cells.extend(batch)
+        return np.array([cell_score(defense, attack) for defense, _, attack in batch])
+
+    monkeypatch.setattr(defense_tap, "evaluate_cells", evaluate_cells)
+    return cells
+
+
+def test_survivors_are_scored_on_every_attack(evaluated):
+    survivors, scores, _ = race_defenses(DEFENSES, SCENARIOS, ATTACKS, "system", keep=2)
+
+    columns, _ = defense_tap.attack_columns(SCENARIOS, ATTACKS)
+    assert len(survivors) >= 2
+    assert scores.shape == (len(survivors), len(columns))
+    assert not np.isnan(scores).any()
+    for row, i in zip(scores, survivors):
+        expected = [cell_score(DEFENSES[i], attack) for _, attack in columns]
+        assert row.tolist() == expected
+
+
+def test_best_defenses_survive_with_fewer_cells(evaluated):
+    survivors, _, count = race_defenses(DEFENSES, SCENARIOS, ATTACKS, "system", keep=2)
+
+    assert survivors[:2] == [0, 1]
+    total = sum(len(a) for a in ATTACKS.values())
+    assert count == len(evaluated) < len(DEFENSES) * total
+
+
+def test_no_cell_is_evaluated_twice(evaluated):
+    race_defenses(DEFENSES, SCENARIOS, ATTACKS, "system", keep=1, eta=3)
+    keys = [(defense, attack) for defense, _, attack in evaluated]
+    assert len(keys) == len(set(keys))
+
+
+def test_rungs_sample_every_scenario(evaluated):
+    race_defenses(DEFENSES, SCENARIOS, ATTACKS, "system", keep=2, initial_per_scenario=1)
+    first_rung = evaluated[: len(DEFENSES) * len(SCENARIOS)]
+    for defense in DEFENSES:
+        scenarios = {scenario for d, scenario, _ in first_rung if d == defense}
+        assert scenarios == set(SCENARIOS)
+
+
+def test_keeping_everything_scores_the_full_grid(evaluated):
+    survivors, scores, count = race_defenses(
+        DEFENSES, SCENARIOS, ATTACKS, "system", keep=len(DEFENSES)
+    )
+    assert survivors == list(range(len(DEFENSES)))
+    assert count == len(DEFENSES) * sum(len(a) for a in ATTACKS.values())
+
+
+def test_same_seed_same_race(evaluated):
+    first = race_defenses(DEFENSES, SCENARIOS, ATTACKS, "system", keep=2, rng=random.Random(7))
+    second = race_defenses(DEFENSES, SCENARIOS, ATTACKS, "system", keep=2, rng=random.Random(7))
+    assert first[0] == second[0]
+    assert first[2] == second[2]
+    assert np.array_equal(first[1], second[1])
+
+
+def test_rejects_bad_arguments(evaluated):
+    with pytest.raises(ValueError):
+        race_defenses(DEFENSES, SCENARIOS, ATTACKS, "system", keep=2, eta=1)
+    with pytest.raises(ValueError):
+        race_defenses(DEFENSES, SCENARIOS, {s: [] for s in SCENARIOS}, "system", keep=2)
@@ -0,0 +1,225 @@
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+
+class Span:
+    """One traced operation; attributes can be added until it ends."""
+
+    __slots__ = (
+        "tracer", "name", "category", "attrs", "span_id", "parent_id", "start", "token", "lane"
+    )
+
+    def __init__(self, tracer: "Tracer", name: str, category: str, attrs: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.attrs = attrs
+        self.span_id = next(tracer.span_ids)
+        parent = current_span.get()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.start = 0.0
+        self.token = None
+        # Inherited so spans recorded after the fact land next to their parent
+        self.lane = parent.lane if parent is not None else 0
+
+    def set(self, **attrs: Any) -> None:
+        self.attrs.update(attrs)
+
+    def __enter__(self) -> "Span":
+        self.token = current_span.set(self)
+        self.lane = self.tracer.enter()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        end = time.perf_counter()
+        current_span.reset(self.token)
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.tracer.record(self, end)
+        self.tracer.leave()
+
+
+class NullSpan:
+    """Stands in for Span when tracing is off, so call sites stay unconditional."""
+
+    __slots__ = ()
+
+    def set(self, **attrs: Any) -> None:
+        pass
+
+    def __enter__(self) -> "NullSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    """Collects spans and writes them as a Chrome trace (chrome://tracing,
+    ui.perfetto.dev).
+
+    Each asyncio task or thread with open spans holds a lane (a track in
+    the viewer) and gives it back when its outermost span ends. Spans
+    therefore nest properly within a lane, and concurrent calls show up
+    side by side in as few lanes as the concurrency needs. span_id and
+    parent_id are stored with each span's attributes, so the run ->
+    scenario -> level -> node -> LLM call tree can be rebuilt even where it
+    crosses lanes.
+    """
+
+    def __init__(self, name: str = "security-test"):
+        self.name = name
+        self.origin = time.perf_counter()
+        self.span_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.events: List[Dict[str, Any]] = []
+        # Task or thread -> [lane, open spans]; freed lanes are reused lowest first
+        self.active: Dict[tuple, List[int]] = {}
+        self.free_lanes: List[int] = []
+        self.lanes = 0
+
+    def span(self, name: str, category: str, attrs: Dict[str, Any]) -> Span:
+        return Span(self, name, category, attrs)
+
+    @staticmethod
+    def owner() -> tuple:
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        return ("task", id(task)) if task is not None else ("thread", threading.get_ident())
+
+    def enter(self) -> int:
+        key = self.owner()
+        with self.lock:
+            entry = self.active.get(key)
+            if entry is None:
+                if self.free_lanes:
+                    lane = heapq.heappop(self.free_lanes)
+                else:
+                    self.lanes += 1
+                    lane = self.lanes
+                entry = self.active[key] = [lane, 0]
+            entry[1] += 1
+            return entry[0]
+
+    def leave(self) -> None:
+        key = self.owner()
+        with self.lock:
+            entry = self.active.get(key)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if not entry[1]:
+                del self.active[key]
+                heapq.heappush(self.free_lanes, entry[0])
+
+    def record(self, span: Span, end: float) -> None:
+        event = {
+            "name": span.name,
+            "cat": span.category,
+            "ph": "X",
+            "ts": round((span.start - self.origin) * 1e6, 1),
+            "dur": round((end - span.start) * 1e6, 1),
+            "pid": 1,
+            "tid": span.lane,
+            "args": {**span.attrs, "span_id": span.span_id, "parent_id": span.parent_id},
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def trace(self) -> Dict[str, Any]:
+        with self.lock:
+            events = list(self.events)
+            lanes = self.lanes
+        metadata = [
+            {"name": "process_name", "ph": "M", "pid": 1, "args": {"name": self.name}}
+        ] + [
+            {"name": "thread_name", "ph": "M", "pid": 1, "tid": lane, "args": {"name": f"lane {lane}"}}
+            for lane in range(1, lanes + 1)
+        ]
+        return {"traceEvents": metadata + events, "displayTimeUnit": "ms"}
+
+    def export(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.trace(), f, default=str)
+        os.replace(tmp_path, path)
+
+
+# The tracer of the run in progress, if it is being traced, and the
+# innermost open span
+current_tracer: ContextVar[Optional[Tracer]] = ContextVar("current_tracer", default=None)
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def span(name: str, category: str = "search", **attrs: Any):
+    # Without an active tracer this is a context variable lookup
+    tracer = current_tracer.get()
+    if tracer is None:
+        return NULL_SPAN
+    return tracer.span(name, category, attrs)
+
+
+@contextmanager
+def tracing(tracer: Optional[Tracer]) -> Iterator[Optional[Tracer]]:
+    # Trace everything run inside the block with `tracer`, if one is given
+    if tracer is None:
+        yield None
+        return
+    token = current_tracer.set(tracer)
+    try:
+        yield tracer
+    finally:
+        current_tracer.reset(token)
+
+
+def add_span(name: str, start: float, category: str = "search", **attrs: Any) -> None:
+    # Record a span that began at perf_counter() `start` and ends now
+    tracer = current_tracer.get()
+    if tracer is None:
+        return
+    trace = tracer.span(name, category, attrs)
+    trace.start = start
+    tracer.record(trace, time.perf_counter())
+
+
+# Directory for per-job trace files; tracing is off when unset
+TRACE_DIR = os.environ.get("TRACE_DIR")
+
+
+def trace_path(job_id: str) -> Optional[str]:
+    return os.path.join(TRACE_DIR, f"{job_id}.json") if TRACE_DIR else None
+
+
+def job_tracer(kind: str, job_id: str) -> Optional[Tracer]:
+    return Tracer(f"{kind} job {job_id}") if TRACE_DIR else None
+
+
+def export_job_trace(tracer: Optional[Tracer], job_id: str) -> None:
+    if tracer is not None:
+        tracer.export(trace_path(job_id))
+
+
+def delete_job_traces(job_ids: List[str]) -> None:
+    # Traces go when their jobs are evicted from the job store
+    if not TRACE_DIR:
+        return
+    for job_id in job_ids:
+        try:
+            os.remove(trace_path(job_id))
+        except OSError:
+            pass
@@ -1,17 +1,17 @@
 from colorama import Fore, Style
 
+COLORS = {
+    "G": Fore.GREEN,
+    "R": Fore.RED,
+    "B": Fore.BLUE,
+    "Y": Fore.YELLOW,
+    "GRAY": Fore.LIGHTBLACK_EX,
+}
 
-def colored_print(text, color: str = "white"):
-    fore_color = None
-    if color == "G":
-        fore_color = Fore.GREEN
-    elif color == "R":
-        fore_color = Fore.RED
-    elif color == "B":
-        fore_color = Fore.BLUE
-    elif color == "Y":
-        fore_color = Fore.YELLOW
-    elif color == "GRAY":
-        fore_color = Fore.LIGHTBLACK_EX
 
-    print(f"{fore_color} {text} {Style.RESET_ALL}")
+def colored_text(text, color: str = "white") -> str:
+    return f"{COLORS.get(color, '')} {text} {Style.RESET_ALL}"
+
+
+def colored_print(text, color: str = "white"):
+    print(colored_text(text, color))